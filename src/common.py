@@ -1,6 +1,45 @@
+import importlib
 import os
-import jinja2
+import threading
 
-JINJA_ENV = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(
-        os.path.join(os.path.dirname(__file__), '..')))
+
+class LazyObject(object):
+    """A proxy to an object that is only built the first time it is used,
+    keeping the cost of building it out of import time.
+    """
+
+    def __init__(self, factory):
+        """Initialize with the callable that builds the object."""
+        self._factory = factory
+        self._obj = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Get the object, building it if this is the first use."""
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    self._obj = self._factory()
+        return self._obj
+
+    def __getattr__(self, name):
+        """Proxy attribute access to the object."""
+        return getattr(self.get(), name)
+
+
+def lazy_import(name):
+    """A proxy to a module that is only imported the first time one of its
+    attributes is used.
+    """
+    return LazyObject(lambda: importlib.import_module(name))
+
+
+def _build_jinja_env():
+    """Build the template environment."""
+    import jinja2
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(
+            os.path.join(os.path.dirname(__file__), '..')))
+
+
+JINJA_ENV = LazyObject(_build_jinja_env)
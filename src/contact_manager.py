@@ -1,17 +1,27 @@
 """Webapp2 interface to the Contact Manger webapp."""
 
+import logging
 import os
 import mimetypes
 
-from sqlalchemy.orm.scoping import scoped_session
-from sqlalchemy.orm import sessionmaker
-
 import webapp2
 import ujson
 
 from src import constants
 from src import common
-from src import models
+from src import encoding
+from src import geo
+from src import singleflight
+from src import validation
+
+# The models and jobs pull in SQLAlchemy's ORM, the bulk of the app's import
+# time, so they are imported on first use (or by `preload`).
+models = common.lazy_import('src.models')
+jobs = common.lazy_import('src.jobs')
+
+
+# Concurrent identical reads share one computation, see `single_flight`.
+READS = singleflight.SingleFlight()
 
 
 class BaseHandler(webapp2.RequestHandler):
@@ -27,6 +37,8 @@ class BaseHandler(webapp2.RequestHandler):
 
     def dispatch(self):
         """Add the database session to the request's scope."""
+        from sqlalchemy.orm import scoped_session, sessionmaker
+
         try:
             self.db_session = scoped_session(sessionmaker(bind=self.engine))
             ret = super(BaseHandler, self).dispatch()
@@ -36,12 +48,64 @@ class BaseHandler(webapp2.RequestHandler):
             self.db_session.rollback()
             raise
 
+    def handle_exception(self, exception, debug):
+        """Answer with 503 Service Unavailable when a coalesced read timed out
+        waiting on the request computing it.
+        """
+        if isinstance(exception, singleflight.Timeout):
+            self.response.set_status(503)
+            return
+        return super(BaseHandler, self).handle_exception(exception, debug)
+
+    def single_flight(self, func, *key):
+        """Run `func` once for all concurrent identical read requests, i.e.
+        the same host (tenant), path and query parameters, plus any extra
+        `key` parts such as a negotiated format.
+        """
+        key = (self.request.host, self.request.path,
+               tuple(sorted(self.request.GET.items()))) + key
+        return READS.do(key, func, timeout=constants.SINGLE_FLIGHT_TIMEOUT)
+
+
+class JSONHandler(BaseHandler):
+    """A handler whose responses are JSON and are compressed when the client
+    accepts it.
+    """
+
+    def dispatch(self):
+        """Encode the response once the handler method has written it."""
+        ret = super(JSONHandler, self).dispatch()
+        encoding.encode_response(self.request, self.response)
+        return ret
+
+    def get_page(self):
+        """Get the `limit` and `offset` of the requested page of a listing,
+        raising ValueError if they are out of range.
+        """
+        params = self.request.GET
+        limit = int(params.get('limit', constants.CONTACTS_PAGE_SIZE))
+        offset = int(params.get('offset', 0))
+        if not 0 < limit <= constants.CONTACTS_MAX_PAGE_SIZE or offset < 0:
+            raise ValueError(
+                'limit must be between 1 and %s and offset at least 0.' %
+                constants.CONTACTS_MAX_PAGE_SIZE)
+        return limit, offset
+
+    def write_json(self, obj, content_type=encoding.JSON_MIMETYPE):
+        """Serialize an object as the JSON response body."""
+        self.response.headers['Content-Type'] = content_type
+        self.response.out.write(ujson.dumps(obj))
+
 
 class Index(BaseHandler):
     """The index page that the user lands on when they hit this app."""
 
     def get(self):
         """Serve up the index template that will load the JS frontend."""
+        self.response.out.write(self.single_flight(self._render))
+
+    def _render(self):
+        """Render the index template with the existing contacts."""
         template_vals = {}
 
         contactmgrs = self.db_session.query(models.ContactManager).all()
@@ -53,12 +117,75 @@ class Index(BaseHandler):
             template_vals.update({'existing_contacts': '<tbody></tbody>'})
 
         template = common.JINJA_ENV.get_template('templates/index.html')
-        self.response.out.write(template.render(template_vals))
+        return template.render(template_vals)
 
 
-class ContactManager(BaseHandler):
+class ContactManager(JSONHandler):
     """The CRUD controller for contact manager actions."""
 
+    def get(self):
+        """List the existing contacts in either the dict or columnar format.
+
+        The listing can be sorted with `sort=<field>` (or `sort=-<field>` for
+        descending), filtered with `state=`, `city=` and `zipcode_prefix=`,
+        and paged with `limit=` and `offset=`; `next_offset` is the offset
+        of the next page, if there is one. `facets=1` adds per state and city
+        counts of all the filtered contacts.
+        """
+        fmt = encoding.negotiate_format(self.request)
+        try:
+            content_type, body = self.single_flight(
+                lambda: self._list_contacts(fmt), fmt)
+        except ValueError as err:
+            self.response.set_status(400)
+            self.write_json({'error': str(err)})
+            return
+
+        self.response.headers['Content-Type'] = content_type
+        self.response.out.write(body)
+
+    def _list_contacts(self, fmt):
+        """Serialize the listing, returning its content type and body."""
+        params = self.request.GET
+        sort = params.get('sort')
+        # Filter values are normalized like the stored values they match,
+        # e.g. state=nc matches NC.
+        filters = {}
+        for name in models.Contact.FILTERS:
+            field = 'zipcode' if name == 'zipcode_prefix' else name
+            value = models.CONTACT_SCHEMA.normalize(field, params.get(name))
+            if value:
+                filters[name] = value
+
+        mgrs = self.db_session.query(models.ContactManager).all()
+        contactmgr_id = mgrs[0].id if mgrs else None
+
+        limit, offset = self.get_page()
+
+        # Fetch one extra contact to tell whether there is a next page.
+        contacts = [contact.to_dict() for contact in
+                    models.query_contacts(self.db_session, contactmgr_id,
+                                          sort=sort, filters=filters,
+                                          limit=limit + 1, offset=offset)]
+
+        next_offset = None
+        if len(contacts) > limit:
+            contacts = contacts[:limit]
+            next_offset = offset + limit
+
+        status = {'contacts': contacts, 'next_offset': next_offset}
+        content_type = encoding.JSON_MIMETYPE
+        if fmt == encoding.FORMAT_COLUMNAR:
+            status['contacts'] = encoding.to_columnar(
+                contacts, models.Contact.FIELDS)
+            content_type = encoding.COLUMNAR_MIMETYPE
+
+        if params.get('facets') in ('1', 'true'):
+            status['facets'] = models.facet_counts(
+                self.db_session, contactmgr_id, filters=filters)
+
+        return content_type, ujson.dumps(status)
+
     def post(self):
         """Create new contact entries."""
         # TODO: tie a contactmgr to User?
@@ -69,7 +196,14 @@ class ContactManager(BaseHandler):
             contactmgr = models.ContactManager()
             self.db_session.add(contactmgr)
 
-        status = contactmgr.update_from_post(self.request, self.db_session)
+        try:
+            status = contactmgr.update_from_post(
+                self.request, self.db_session)
+        except validation.ValidationError as err:
+            self.db_session.rollback()
+            self.response.set_status(400)
+            self.write_json({'errors': err.errors})
+            return
         if status is None:
             # TODO: This should be handled in the frontend with ui-state-error.
             return False
@@ -79,7 +213,7 @@ class ContactManager(BaseHandler):
         if contactmgr.id < 1:
             self.db_session.commit()
 
-        self.response.out.write(ujson.dumps(status))
+        self.write_json(status)
 
     def delete(self):
         """Delete contact entries."""
@@ -101,6 +235,156 @@ class ContactManager(BaseHandler):
         self.response.out.write(True);
 
 
+class ContactNearby(JSONHandler):
+    """Proximity search over the contacts."""
+
+    def get(self):
+        """List the contacts within `radius` miles of the `zip` code's
+        centroid, nearest first, in either the dict or columnar format.
+
+        The results are paged like the GET /cmgr listing, with `limit=` and
+        `offset=`; `next_offset` is the offset of the next page, if any.
+        """
+        location = geo.locate(self.request.GET.get('zip', '').strip())
+        try:
+            radius = float(self.request.GET.get('radius', ''))
+        except ValueError:
+            radius = None
+
+        if location is None:
+            error = 'Unknown ZIP code.'
+        elif radius is None or not 0 < radius <= constants.NEARBY_MAX_RADIUS:
+            error = 'radius must be a number of miles up to %s.' % (
+                constants.NEARBY_MAX_RADIUS)
+        else:
+            error = None
+            try:
+                limit, offset = self.get_page()
+            except ValueError as err:
+                error = str(err)
+        if error is not None:
+            self.response.set_status(400)
+            self.write_json({'error': error})
+            return
+
+        fmt = encoding.negotiate_format(self.request)
+        content_type, body = self.single_flight(
+            lambda: self._list_nearby(location, radius, limit, offset, fmt),
+            fmt)
+
+        self.response.headers['Content-Type'] = content_type
+        self.response.out.write(body)
+
+    def _list_nearby(self, location, radius, limit, offset, fmt):
+        """Serialize the search results, returning their content type and
+        body.
+        """
+        mgrs = self.db_session.query(models.ContactManager).all()
+        contactmgr_id = mgrs[0].id if mgrs else None
+
+        # Fetch one extra contact to tell whether there is a next page.
+        contacts = []
+        for contact, distance in models.nearby_contacts(
+                self.db_session, contactmgr_id, location[0], location[1],
+                radius, limit=limit + 1, offset=offset):
+            contact_dict = contact.to_dict()
+            contact_dict['distance'] = round(distance, 2)
+            contacts.append(contact_dict)
+
+        next_offset = None
+        if len(contacts) > limit:
+            contacts = contacts[:limit]
+            next_offset = offset + limit
+
+        status = {'contacts': contacts, 'next_offset': next_offset}
+        content_type = encoding.JSON_MIMETYPE
+        if fmt == encoding.FORMAT_COLUMNAR:
+            status['contacts'] = encoding.to_columnar(
+                contacts, models.Contact.FIELDS + ('distance',))
+            content_type = encoding.COLUMNAR_MIMETYPE
+        return content_type, ujson.dumps(status)
+
+
+class Jobs(JSONHandler):
+    """Start background jobs."""
+
+    def post(self):
+        """Start a job of the given `kind`, processing `chunk_size` contacts
+        per checkpoint in each of `concurrency` ranges of contacts.
+
+        The job is answered with 202 Accepted. If the job runner isn't
+        started, e.g. under a WSGI server other than `main`'s, it stays
+        pending until a started runner resumes it.
+        """
+        try:
+            body = ujson.loads(self.request.body or '{}')
+            kind = body.get('kind')
+            chunk_size = int(body.get('chunk_size', constants.JOB_CHUNK_SIZE))
+            concurrency = int(body.get('concurrency', 1))
+        except (AttributeError, TypeError, ValueError):
+            kind, chunk_size, concurrency = None, None, None
+
+        if kind not in jobs.TASKS:
+            error = 'kind must be one of %s.' % ', '.join(sorted(jobs.TASKS))
+        elif chunk_size is None or chunk_size < 1:
+            error = 'chunk_size must be a positive integer.'
+        elif (concurrency is None or
+              not 0 < concurrency <= constants.JOB_MAX_CONCURRENCY):
+            error = 'concurrency must be between 1 and %s.' % (
+                constants.JOB_MAX_CONCURRENCY)
+        else:
+            error = None
+        if error is not None:
+            self.response.set_status(400)
+            self.write_json({'error': error})
+            return
+
+        job = models.Job(kind, chunk_size, params=body.get('params'),
+                         concurrency=concurrency)
+        self.db_session.add(job)
+        self.db_session.commit()
+
+        try:
+            self.app.job_runner.submit(job.id, self.engine)
+        except jobs.NotStarted:
+            logging.warning('Job %s is pending: the job runner is not '
+                            'started.', job.id)
+
+        self.response.set_status(202)
+        self.response.headers['Location'] = '/jobs/%s' % job.id
+        self.write_json(job.to_dict())
+
+
+class JobStatus(JSONHandler):
+    """Report on and cancel background jobs."""
+
+    def _get_job(self, job_id):
+        """Get a job, answering with 404 Not Found if it doesn't exist."""
+        job = self.db_session.query(models.Job).get(int(job_id))
+        if job is None:
+            self.response.set_status(404)
+            self.write_json({'error': 'No such job.'})
+        return job
+
+    def get(self, job_id):
+        """Report a job's progress and throughput."""
+        job = self._get_job(job_id)
+        if job is not None:
+            self.write_json(job.to_dict())
+
+    def delete(self, job_id):
+        """Request a job's cancellation, which the worker notices before
+        its next chunk.
+        """
+        job = self._get_job(job_id)
+        if job is None:
+            return
+        if job.state not in models.Job.FINISHED:
+            job.cancel_requested = True
+            self.db_session.commit()
+        self.write_json(job.to_dict())
+
+
 class StaticFileHandler(webapp2.RequestHandler):
     """Handle static files in paste."""
 
@@ -122,15 +406,66 @@ class StaticFileHandler(webapp2.RequestHandler):
             self.response.set_status(404)
 
 
-APP = webapp2.WSGIApplication([
+ROUTES = [
     ('/', Index),
     ('/cmgr', ContactManager),
+    ('/cmgr/nearby', ContactNearby),
+    ('/jobs', Jobs),
+    (r'/jobs/(\d+)', JobStatus),
     (r'/static/(.+)', StaticFileHandler)
-], debug=True)
+]
+
+
+def create_app(engine=None, debug=True, job_workers=constants.JOB_WORKERS):
+    """Create the WSGI app. Nothing expensive happens here: the models, the
+    engine, the templates and the job runner are set up on first use, or up
+    front by `preload`, and the job runner's pool is started by `main`.
+    """
+    app = webapp2.WSGIApplication(ROUTES, debug=debug)
+    app.job_runner = common.LazyObject(
+        lambda: jobs.JobRunner(processes=job_workers))
+    if engine is not None:
+        app.engine = engine
+    return app
+
+
+def preload(app):
+    """Warm everything that is otherwise set up on first use, so that the
+    first requests (of every worker forked afterwards) don't pay for it.
+    """
+    engine = getattr(app, 'engine', None) or models.get_engine()
+    # Connect once to load the DBAPI and dialect, but don't keep connections
+    # around to be shared with forked workers.
+    engine.connect().close()
+    engine.dispose()
+
+    jobs.get()
+    common.JINJA_ENV.get_template('templates/index.html')
+    geo.CENTROIDS.get()
+    mimetypes.init()
+
+
+APP = create_app()
 
 
 def main():
+    import argparse
     from paste import httpserver
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--preload', action='store_true',
+                        help='warm the engine, templates, etc. up front')
+    args = parser.parse_args()
+
+    if args.preload:
+        preload(APP)
+
+    # Fork the job pool before the server starts its threads, then pick up
+    # pending jobs and, once they are stale, the jobs that were running when
+    # a server last stopped.
+    APP.job_runner.start()
+    APP.job_runner.watch(getattr(APP, 'engine', None) or models.get_engine())
+
     httpserver.serve(APP, host='127.0.0.1', port='8080')
     #APP.run()
 
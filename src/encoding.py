@@ -0,0 +1,151 @@
+"""Response encoding for the JSON resources served under /cmgr.
+
+Two independent things are negotiated here:
+
+    - the body format, either the plain list-of-dicts format the frontend
+      already understands or a columnar format that sends the field names once
+      followed by rows of values.
+    - the content encoding, gzip/deflate (and brotli when the library is
+      installed) for bodies that are large enough to be worth compressing.
+"""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from src import constants
+
+
+FORMAT_DICT = 'dict'
+FORMAT_COLUMNAR = 'columnar'
+FORMATS = (FORMAT_DICT, FORMAT_COLUMNAR)
+
+COLUMNAR_MIMETYPE = 'application/vnd.cmgr.columnar+json'
+JSON_MIMETYPE = 'application/json'
+
+
+def available_encodings():
+    """The content encodings this server can produce, most preferred first."""
+    encodings = ['gzip', 'deflate']
+    if brotli is not None:
+        encodings.insert(0, 'br')
+    return encodings
+
+
+def parse_qvalues(header):
+    """Parse an Accept or Accept-Encoding header into a dict of media type or
+    coding -> q value. Parameters other than q are ignored.
+    """
+    qvalues = {}
+    for part in (header or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        params = part.split(';')
+        token = params[0].strip().lower()
+        qvalue = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[token] = qvalue
+    return qvalues
+
+
+def negotiate_encoding(header):
+    """Pick the best content encoding for an Accept-Encoding header, or None
+    if the body should be sent as is.
+    """
+    codings = parse_qvalues(header)
+    wildcard = codings.get('*', 0.0)
+
+    best, best_q = None, 0.0
+    for coding in available_encodings():
+        qvalue = codings.get(coding, wildcard)
+        if qvalue > best_q:
+            best, best_q = coding, qvalue
+    return best
+
+
+def negotiate_format(request):
+    """Pick the body format from the `format` query parameter, falling back
+    to the Accept header: the columnar format is sent when the client
+    accepts it at least as much as plain JSON.
+    """
+    fmt = request.GET.get('format')
+    if fmt in FORMATS:
+        return fmt
+
+    media_types = parse_qvalues(request.headers.get('Accept'))
+    columnar_q = media_types.get(COLUMNAR_MIMETYPE, 0.0)
+    json_q = max(media_types.get(JSON_MIMETYPE, 0.0),
+                 media_types.get('application/*', 0.0),
+                 media_types.get('*/*', 0.0))
+    if columnar_q > 0 and columnar_q >= json_q:
+        return FORMAT_COLUMNAR
+    return FORMAT_DICT
+
+
+def add_vary(response, *headers):
+    """Add request headers to a response's Vary header, keeping the ones it
+    already lists.
+    """
+    current = [name.strip() for name in
+               response.headers.get('Vary', '').split(',') if name.strip()]
+    known = set(name.lower() for name in current)
+    for header in headers:
+        if header.lower() not in known:
+            current.append(header)
+            known.add(header.lower())
+    response.headers['Vary'] = ', '.join(current)
+
+
+def compress(body, coding):
+    """Compress a body with the given content coding."""
+    if coding == 'gzip':
+        compressor = zlib.compressobj(
+            constants.COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    if coding == 'deflate':
+        return zlib.compress(body, constants.COMPRESSION_LEVEL)
+    if coding == 'br':
+        return brotli.compress(body)
+    raise ValueError('Unsupported content coding: %s' % coding)
+
+
+def to_columnar(dicts, fields):
+    """Serialize a list of dicts into the columnar format."""
+    return {
+        'fields': list(fields),
+        'rows': [[item[field] for field in fields] for item in dicts],
+    }
+
+
+def encode_response(request, response):
+    """Compress a response in place if the client accepts it and the body is
+    above the size threshold.
+
+    The body's format and encoding both depend on the request, so caches are
+    told to vary on Accept and Accept-Encoding.
+    """
+    if 'Content-Encoding' in response.headers:
+        return response
+    add_vary(response, 'Accept', 'Accept-Encoding')
+
+    body = response.body
+    if len(body) < constants.COMPRESSION_MIN_SIZE:
+        return response
+
+    coding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+    if coding is None:
+        return response
+
+    response.body = compress(body, coding)
+    response.headers['Content-Encoding'] = coding
+    return response
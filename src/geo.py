@@ -0,0 +1,181 @@
+"""Offline ZIP code geolocation and proximity search helpers.
+
+Contacts are located by the centroid of their ZIP code and bucketed into a
+grid of GEO_CELL_DEGREES sized cells numbered row by row, so that the cells
+a search radius covers form a few contiguous runs of cell numbers, i.e. a few
+range scans on an index of the contacts' cells. The candidates those scans
+return are then filtered by their actual distance.
+"""
+
+import math
+import os
+
+from src import common
+from src import constants
+
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE_LAT = 69.0
+
+CENTROIDS_PATH = os.path.join(
+    os.path.dirname(__file__), 'data', 'zip_centroids.txt')
+
+GRID_COLS = int(round(360.0 / constants.GEO_CELL_DEGREES))
+GRID_ROWS = int(round(180.0 / constants.GEO_CELL_DEGREES))
+
+
+def load_centroids(path=CENTROIDS_PATH):
+    """Load the ZIP centroids from a tab separated file laid out like the
+    Census Bureau's ZCTA Gazetteer file, into a dict of ZIP -> (lat, lon).
+    """
+    centroids = {}
+    with open(path) as f:
+        header = None
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            cells = [cell.strip() for cell in line.split('\t')]
+            if header is None:
+                header = cells
+                zip_idx = header.index('GEOID')
+                lat_idx = header.index('INTPTLAT')
+                lon_idx = header.index('INTPTLONG')
+                continue
+            centroids[cells[zip_idx]] = (
+                float(cells[lat_idx]), float(cells[lon_idx]))
+    return centroids
+
+
+CENTROIDS = common.LazyObject(load_centroids)
+
+
+def locate(zipcode):
+    """Get the (lat, lon) centroid of a ZIP or ZIP+4 code, or None if it is
+    unknown.
+    """
+    if not zipcode:
+        return None
+    return CENTROIDS.get().get(zipcode[:5])
+
+
+def _row(lat):
+    """The grid row of a latitude."""
+    row = int(math.floor((lat + 90.0) / constants.GEO_CELL_DEGREES))
+    return min(max(row, 0), GRID_ROWS - 1)
+
+
+def _col(lon):
+    """The grid column of a longitude."""
+    col = int(math.floor((lon + 180.0) / constants.GEO_CELL_DEGREES))
+    return col % GRID_COLS
+
+
+def cell(lat, lon):
+    """The grid cell number of a point."""
+    return _row(lat) * GRID_COLS + _col(lon)
+
+
+def cell_ranges(lat, lon, radius):
+    """The inclusive (first, last) runs of cell numbers that cover every
+    point within `radius` miles of a point.
+    """
+    dlat = radius / MILES_PER_DEGREE_LAT
+    south, north = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+
+    # Longitude degrees shrink towards the poles, so size the band for the
+    # latitude furthest from the equator.
+    widest = max(abs(south), abs(north))
+    cos_lat = math.cos(math.radians(widest))
+    if cos_lat < 1e-6:
+        dlon = 180.0
+    else:
+        dlon = radius / (MILES_PER_DEGREE_LAT * cos_lat)
+
+    if dlon >= 180.0:
+        cols = [(0, GRID_COLS - 1)]
+    else:
+        west, east = _col(lon - dlon), _col(lon + dlon)
+        if west <= east:
+            cols = [(west, east)]
+        else:
+            # The band wraps around the antimeridian.
+            cols = [(0, east), (west, GRID_COLS - 1)]
+
+    ranges = []
+    for row in range(_row(south), _row(north) + 1):
+        for first, last in cols:
+            first, last = row * GRID_COLS + first, row * GRID_COLS + last
+            if ranges and ranges[-1][1] + 1 == first:
+                ranges[-1] = (ranges[-1][0], last)
+            else:
+                ranges.append((first, last))
+    return ranges
+
+
+def _numpy():
+    """Import NumPy if it is installed, only once it's needed."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _numpy_distances(numpy, lat, lon, lats, lons):
+    """The haversine distances in miles from a point to each of the points
+    of the `lats` and `lons` sequences, as a NumPy array.
+    """
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    lats = numpy.radians(numpy.asarray(lats, dtype=float))
+    lons = numpy.radians(numpy.asarray(lons, dtype=float))
+    a = (numpy.sin((lats - lat1) / 2.0) ** 2 +
+         math.cos(lat1) * numpy.cos(lats) *
+         numpy.sin((lons - lon1) / 2.0) ** 2)
+    return 2.0 * EARTH_RADIUS_MILES * numpy.arcsin(
+        numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def distances(lat, lon, lats, lons):
+    """The haversine distances in miles from a point to each of the points
+    given by the `lats` and `lons` sequences, vectorized with NumPy when it
+    is installed.
+    """
+    numpy = _numpy()
+    if numpy is None:
+        return [_haversine(lat, lon, lat2, lon2)
+                for lat2, lon2 in zip(lats, lons)]
+    return _numpy_distances(numpy, lat, lon, lats, lons).tolist()
+
+
+def nearest(lat, lon, radius, ids, lats, lons, limit=None, offset=0):
+    """Rank points given by the `ids`, `lats` and `lons` sequences by their
+    distance from a point, returning a page of the (id, distance) pairs of
+    those within `radius` miles, nearest first and then by id.
+
+    With NumPy installed the points are filtered and sorted as arrays and
+    only the requested page is turned back into Python objects.
+    """
+    end = None if limit is None else offset + limit
+    numpy = _numpy()
+    if numpy is None:
+        found = [(id_, distance) for id_, distance in
+                 zip(ids, distances(lat, lon, lats, lons))
+                 if distance <= radius]
+        found.sort(key=lambda pair: (pair[1], pair[0]))
+        return found[offset:end]
+
+    ids = numpy.asarray(ids, dtype=numpy.int64)
+    found = _numpy_distances(numpy, lat, lon, lats, lons)
+    within = found <= radius
+    ids, found = ids[within], found[within]
+    # lexsort sorts by its last key first.
+    order = numpy.lexsort((ids, found))[offset:end]
+    return list(zip(ids[order].tolist(), found[order].tolist()))
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    """The haversine distance in miles between two points."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2.0) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2.0) ** 2)
+    return 2.0 * EARTH_RADIUS_MILES * math.asin(math.sqrt(min(a, 1.0)))
@@ -0,0 +1,351 @@
+"""A local background job runner for long running contact maintenance tasks.
+
+Jobs are rows in the `jobs` table. A runner first claims a job atomically, so
+that no two runners (e.g. two servers resuming jobs) run it at once, then
+splits its contacts into `concurrency` ranges of ids. A worker per range
+processes its contacts in chunks of ascending ids and commits each chunk's
+changes together with the range's cursor (the last id processed), so a job
+that is interrupted resumes after its last checkpoints, and a cancellation
+requested through the API is noticed between chunks. Workers run in a local
+process pool; no broker is needed.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, create_engine, exists, func, or_
+from sqlalchemy.orm import sessionmaker
+
+from src import constants
+from src import models
+
+
+# kind -> function(session, contacts, params) processing a chunk of contacts.
+TASKS = {}
+
+
+class NotStarted(RuntimeError):
+    """A job was submitted to a runner whose process pool isn't started."""
+
+
+def task(kind):
+    """Register a function as the task for a kind of job."""
+    def decorator(func):
+        TASKS[kind] = func
+        return func
+    return decorator
+
+
+@task('normalize')
+def normalize(session, contacts, params):
+    """Re-apply the validation layer's normalization to stored contacts."""
+    for contact in contacts:
+        for field in models.CONTACT_SCHEMA.fields:
+            value = getattr(contact, field)
+            normalized = models.CONTACT_SCHEMA.normalize(field, value)
+            if normalized != (value or ''):
+                setattr(contact, field, normalized)
+
+
+@task('relocate')
+def relocate(session, contacts, params):
+    """Re-resolve the location of contacts from their ZIP codes, e.g. after
+    the centroids file was updated.
+    """
+    for contact in contacts:
+        contact.locate()
+
+
+@task('dedup')
+def dedup(session, contacts, params):
+    """Delete contacts with the same contact manager, name and ZIP code as a
+    contact with a lower id.
+
+    The chunk's duplicate groups and the lowest id of each are found with one
+    grouped query, narrowed by the (contactmgr_id, lastname, id) index to the
+    chunk's contact managers and last names. The lowest ids are never
+    deleted, so the ranges of a job can be deduplicated concurrently.
+    """
+    Contact = models.Contact
+    key = (Contact.contactmgr_id, Contact.lastname, Contact.firstname,
+           Contact.zipcode)
+    groups = session.query(*(key + (func.min(Contact.id),))).filter(
+        Contact.contactmgr_id.in_(
+            set(contact.contactmgr_id for contact in contacts))).filter(
+        Contact.lastname.in_(
+            set(contact.lastname for contact in contacts))).group_by(
+        *key).having(func.count(Contact.id) > 1)
+    first_ids = dict((tuple(row[:-1]), row[-1]) for row in groups)
+
+    for contact in contacts:
+        first_id = first_ids.get((contact.contactmgr_id, contact.lastname,
+                                  contact.firstname, contact.zipcode))
+        if first_id is not None and first_id < contact.id:
+            session.delete(contact)
+
+
+def claim(session, job_id, owner):
+    """Claim a job for the runner `owner` if it is pending, or running but
+    abandoned by its runner. The claim is a single conditional UPDATE, so
+    only one of the runners racing for a job gets it.
+    """
+    Job = models.Job
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=constants.JOB_STALE_AFTER)
+    claimed = session.query(Job).filter(Job.id == job_id).filter(or_(
+        Job.state == Job.PENDING,
+        and_(Job.state == Job.RUNNING,
+             or_(Job.heartbeat == None, Job.heartbeat < stale)))).update(
+        {Job.state: Job.RUNNING, Job.owner: owner, Job.heartbeat: now},
+        synchronize_session=False)
+    session.commit()
+    return claimed == 1
+
+
+def plan(session, job_id):
+    """Split a claimed job's contacts into `concurrency` ranges of about the
+    same number of contacts, unless an earlier run already did, and return
+    the ids of the ranges that aren't done.
+    """
+    job = session.query(models.Job).get(job_id)
+    if not job.ranges:
+        ids = session.query(models.Contact.id).order_by(models.Contact.id)
+        job.total = ids.count()
+        job.started = job.started or datetime.utcnow()
+
+        count = max(1, min(job.concurrency or 1, job.total))
+        cursor = 0
+        for index in range(1, count):
+            last_id = ids.offset(job.total * index // count - 1).limit(
+                1).scalar()
+            job.ranges.append(models.JobRange(cursor, last_id))
+            cursor = last_id
+        job.ranges.append(models.JobRange(cursor))
+        session.commit()
+
+    return [job_range.id for job_range in job.ranges if not job_range.done]
+
+
+def _checkpoint(session, job_id, owner, processed):
+    """Count a chunk as processed and renew the owner's claim on the job,
+    in the chunk's transaction. Returns False if the job was finished, e.g.
+    cancelled by another range, or claimed by another runner meanwhile.
+    """
+    Job = models.Job
+    return session.query(Job).filter(
+        Job.id == job_id, Job.owner == owner,
+        Job.state == Job.RUNNING).update(
+        {Job.processed: Job.processed + processed,
+         Job.heartbeat: datetime.utcnow()},
+        synchronize_session=False) == 1
+
+
+def _finish(session, job_id, owner, state, error=None):
+    """Mark a job the owner holds as finished. It is only done once all of
+    its ranges are.
+    """
+    Job, JobRange = models.Job, models.JobRange
+    query = session.query(Job).filter(
+        Job.id == job_id, Job.owner == owner, Job.state == Job.RUNNING)
+    if state == Job.DONE:
+        query = query.filter(~exists().where(and_(
+            JobRange.job_id == job_id, JobRange.done == False)))
+    query.update({Job.state: state, Job.error: error,
+                  Job.finished: datetime.utcnow()},
+                 synchronize_session=False)
+    session.commit()
+
+
+def run_range(range_id, owner, engine):
+    """Process a range of a job's contacts chunk by chunk from its cursor
+    until they are all processed, the job is cancelled, finished or claimed
+    by another runner, or its task fails.
+    """
+    session = sessionmaker(bind=engine)()
+    try:
+        job_range = session.query(models.JobRange).get(range_id)
+        if job_range is None or job_range.done:
+            return
+        job = job_range.job
+
+        try:
+            func = TASKS[job.kind]
+            params = job.to_dict()['params']
+
+            while True:
+                # The job is reloaded after every commit, picking up
+                # cancellations requested meanwhile.
+                if job.cancel_requested:
+                    _finish(session, job.id, owner, models.Job.CANCELLED)
+                    return
+
+                query = session.query(models.Contact).filter(
+                    models.Contact.id > job_range.cursor)
+                if job_range.last_id is not None:
+                    query = query.filter(
+                        models.Contact.id <= job_range.last_id)
+                contacts = query.order_by(models.Contact.id).limit(
+                    job.chunk_size).all()
+                if not contacts:
+                    job_range.done = True
+                    session.commit()
+                    _finish(session, job.id, owner, models.Job.DONE)
+                    return
+
+                func(session, contacts, params)
+
+                # Checkpoint the chunk's changes along with the cursor.
+                job_range.cursor = contacts[-1].id
+                if not _checkpoint(session, job.id, owner, len(contacts)):
+                    session.rollback()
+                    return
+                session.commit()
+        except Exception:
+            session.rollback()
+            _finish(session, job.id, owner, models.Job.FAILED,
+                    error=traceback.format_exc())
+    finally:
+        session.close()
+
+
+_ENGINES = {}
+
+
+def _get_engine(db_uri):
+    """Get the engine of this pool process for a database."""
+    if db_uri not in _ENGINES:
+        _ENGINES[db_uri] = create_engine(db_uri, **constants.DB_URI_ARGS)
+    return _ENGINES[db_uri]
+
+
+def _mark_failed(range_id, owner, db_uri, error):
+    """Mark the job of a range that couldn't be run as failed, if the
+    database can be reached at all.
+    """
+    try:
+        session = sessionmaker(bind=_get_engine(db_uri))()
+        try:
+            job_range = session.query(models.JobRange).get(range_id)
+            if job_range is not None:
+                _finish(session, job_range.job_id, owner, models.Job.FAILED,
+                        error=error)
+        finally:
+            session.close()
+    except Exception:
+        logging.exception('Could not mark the job of range %s as failed',
+                          range_id)
+
+
+def _run_in_process(range_id, owner, db_uri):
+    """Run a job's range in a pool process, with an engine of that process.
+
+    Nothing is raised back to the pool, where it would go unnoticed: errors
+    that `run_range` doesn't handle itself, e.g. failing to connect, are
+    logged and mark the job as failed.
+    """
+    try:
+        run_range(range_id, owner, _get_engine(db_uri))
+    except Exception:
+        error = traceback.format_exc()
+        logging.error('Job range %s failed to run:\n%s', range_id, error)
+        _mark_failed(range_id, owner, db_uri, error)
+
+
+class JobRunner(object):
+    """Runs jobs in a local process pool, or inline in the calling thread
+    when it has no processes.
+    """
+
+    def __init__(self, processes=constants.JOB_WORKERS):
+        """Initialize with the number of job ranges to run concurrently."""
+        self.processes = processes
+        # Identifies this runner's claims on jobs.
+        self.owner = '%s:%s:%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the process pool. Call this before the server starts any
+        threads, so that the pool's processes aren't forked from a
+        multi-threaded process.
+        """
+        with self._lock:
+            if self.processes and self._pool is None:
+                import multiprocessing
+                self._pool = multiprocessing.Pool(self.processes)
+
+    def submit(self, job_id, engine):
+        """Claim a job and run its ranges against the database of `engine`,
+        returning the pool's AsyncResults of the ranges submitted.
+
+        Nothing runs if the job is finished or another runner holds it.
+        Raises NotStarted, leaving the job pending for `resume`, if the pool
+        isn't started.
+        """
+        if self.processes and self._pool is None:
+            raise NotStarted('The job runner has not been started.')
+
+        session = sessionmaker(bind=engine)()
+        try:
+            if not claim(session, job_id, self.owner):
+                return []
+            range_ids = plan(session, job_id)
+        finally:
+            session.close()
+
+        if not self.processes:
+            for range_id in range_ids:
+                run_range(range_id, self.owner, engine)
+            return []
+        return [self._pool.apply_async(
+                    _run_in_process, (range_id, self.owner, str(engine.url)))
+                for range_id in range_ids]
+
+    def resume(self, engine):
+        """Resubmit the jobs that are pending, or were interrupted when their
+        runner stopped, e.g. because the server was restarted. They continue
+        from their last checkpoints.
+        """
+        session = sessionmaker(bind=engine)()
+        try:
+            query = session.query(models.Job.id).filter(
+                ~models.Job.state.in_(models.Job.FINISHED))
+            job_ids = [job_id for job_id, in query.order_by(models.Job.id)]
+        finally:
+            session.close()
+
+        for job_id in job_ids:
+            self.submit(job_id, engine)
+
+    def watch(self, engine, interval=constants.JOB_STALE_AFTER):
+        """Resume jobs now and then every `interval` seconds in a daemon
+        thread, so that the jobs of runners that stopped, including this
+        server's previous run, are picked up once they are stale.
+        """
+        def resume_forever():
+            while True:
+                try:
+                    self.resume(engine)
+                except Exception:
+                    logging.exception('Could not resume jobs')
+                time.sleep(interval)
+
+        thread = threading.Thread(target=resume_forever, name='job-watcher')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def close(self):
+        """Stop the pool once the submitted jobs are done."""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
@@ -2,21 +2,36 @@
 that the front end will understand.
 """
 
+import threading
 from datetime import datetime
 
 import ujson
-from sqlalchemy import Column, DateTime, Integer, ForeignKey, String
-from sqlalchemy import create_engine
+from sqlalchemy import Boolean, Column, DateTime, Float, Integer, ForeignKey
+from sqlalchemy import Index, String, Text, create_engine, func, inspect, or_
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, validates
 from sqlalchemy.orm.scoping import scoped_session
 
 from src import constants
+from src import geo
+from src import validation
+
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
 
 
 def get_engine():
-    """Get the engine as specified by the constant configuration."""
-    return create_engine(constants.DB_URI, **constants.DB_URI_ARGS)
+    """Get the engine as specified by the constant configuration. The engine
+    is created on first use and shared afterwards.
+    """
+    global _ENGINE
+    if _ENGINE is None:
+        with _ENGINE_LOCK:
+            if _ENGINE is None:
+                _ENGINE = create_engine(
+                    constants.DB_URI, **constants.DB_URI_ARGS)
+    return _ENGINE
 
 
 #Session = scoped_session(sessionmaker(bind=get_engine()))
@@ -38,6 +53,34 @@ class Contact(Base, BaseMixIn):
     """
     __tablename__ = 'contacts'
 
+    # Every listing is scoped to a contact manager and ends its ORDER BY
+    # with the id, so the indexes are (contactmgr_id, [state,] <sort>, id):
+    # a sort, or a state filter plus a sort, reads rows in index order.
+    __table_args__ = (
+        Index('ix_contacts_mgr_id', 'contactmgr_id', 'id'),
+        Index('ix_contacts_mgr_firstname',
+              'contactmgr_id', 'firstname', 'id'),
+        Index('ix_contacts_mgr_lastname', 'contactmgr_id', 'lastname', 'id'),
+        Index('ix_contacts_mgr_zipcode', 'contactmgr_id', 'zipcode', 'id'),
+        Index('ix_contacts_mgr_city', 'contactmgr_id', 'city', 'id'),
+        Index('ix_contacts_mgr_state', 'contactmgr_id', 'state', 'id'),
+        Index('ix_contacts_mgr_state_firstname',
+              'contactmgr_id', 'state', 'firstname', 'id'),
+        Index('ix_contacts_mgr_state_lastname',
+              'contactmgr_id', 'state', 'lastname', 'id'),
+        Index('ix_contacts_mgr_state_zipcode',
+              'contactmgr_id', 'state', 'zipcode', 'id'),
+        Index('ix_contacts_mgr_state_city',
+              'contactmgr_id', 'state', 'city', 'id'),
+        Index('ix_contacts_mgr_geocell',
+              'contactmgr_id', 'geocell', 'latitude', 'longitude'),
+    )
+
+    # The serialized fields, in the order the frontend's table displays them.
+    FIELDS = ('id', 'firstname', 'lastname', 'zipcode', 'city', 'state')
+    SORTABLE = ('firstname', 'lastname', 'zipcode', 'city', 'state')
+    FILTERS = ('state', 'city', 'zipcode_prefix')
+
     contactmgr_id = Column(Integer, ForeignKey('contactmgrs.id'))
     firstname = Column(String(128))
     lastname = Column(String(128))
@@ -45,6 +88,11 @@ class Contact(Base, BaseMixIn):
     city = Column(String(256))
     state = Column(String(4))
 
+    # Located from the ZIP code's centroid, see `geo`.
+    latitude = Column(Float)
+    longitude = Column(Float)
+    geocell = Column(Integer)
+
     def __init__(self, firstname='', lastname='', zipcode='', city='',
                  state=''):
         """Initialize instance."""
@@ -54,6 +102,23 @@ class Contact(Base, BaseMixIn):
         self.city = city
         self.state = state
 
+    @validates('zipcode')
+    def _locate_zipcode(self, key, zipcode):
+        """Locate the contact whenever its ZIP code is set."""
+        self.locate(zipcode)
+        return zipcode
+
+    def locate(self, zipcode=None):
+        """Set the location from the centroid of a ZIP code, by default the
+        contact's own.
+        """
+        location = geo.locate(self.zipcode if zipcode is None else zipcode)
+        if location is None:
+            self.latitude = self.longitude = self.geocell = None
+        else:
+            self.latitude, self.longitude = location
+            self.geocell = geo.cell(*location)
+
     def __repr__(self):
         """Human readable representation."""
         fmt = '<%s(id=%s, cmgrId=%s, firstname=%s, lastname=%s) %s>'
@@ -77,7 +142,8 @@ class ContactManager(Base, BaseMixIn):
     __tablename__ = 'contactmgrs'
 
     title = Column(String(256))
-    contacts = relationship('Contact', backref='contactmgrs')
+    contacts = relationship(
+        'Contact', order_by='Contact.id', backref='contactmgrs')
 
     def __init__(self, title='', contacts=None):
         """Initialize instance."""
@@ -130,19 +196,27 @@ class ContactManager(Base, BaseMixIn):
     def update_from_post(self, request, session):
         """Serialize a POST request into either creating new contacts or
         updating existing contacts.
+
+        The whole batch is validated before anything is written and a
+        ValidationError is raised if any row is bad.
         """
+        try:
+            rows = ujson.loads(request.body)
+        except ValueError:
+            raise validation.ValidationError({'rows': 'must be valid JSON'})
+        rows = CONTACT_SCHEMA.validate_table_rows(rows)
+
         try:
             existing = [contact.id for contact in self.contacts]
             modified = []
 
-            rows = ujson.loads(request.body)
-            for _, id_, fname, lname, zipcode, city, state in rows:
-                if id_ == '-1':
-                    contact = Contact(
-                        fname, lname, zipcode, city, state)
+            for row in rows:
+                id_ = row.pop('id')
+                if id_ == validation.NEW_ID:
+                    contact = Contact(**row)
                     self.contacts.append(contact)
                 else:
-                    contact = filter(lambda x: x.id == int(id_), self.contacts)
+                    contact = filter(lambda x: x.id == id_, self.contacts)
                     if not contact:
                         if constants.DEBUG_MODE is True:
                             raise Exception(
@@ -162,11 +236,8 @@ class ContactManager(Base, BaseMixIn):
                     #
                     # For simplicity, i'll just update the contact regardless.
 
-                    contact.firstname = fname
-                    contact.lastname = lname
-                    contact.zipcode = zipcode
-                    contact.city = city
-                    contact.state = state
+                    for field, value in row.items():
+                        setattr(contact, field, value)
 
                     session.add(contact)
 
@@ -185,10 +256,261 @@ class ContactManager(Base, BaseMixIn):
         return {'created': created, 'modified': modified}
 
 
+CONTACT_SCHEMA = validation.ContactSchema(Contact)
+
+
+class Job(Base, BaseMixIn):
+    """A long running maintenance task over the contacts. The contacts are
+    split into `concurrency` ranges of ids, each processed by its own worker
+    in checkpointed chunks of contacts ordered by id.
+    """
+    __tablename__ = 'jobs'
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    FINISHED = (DONE, FAILED, CANCELLED)
+
+    kind = Column(String(64))
+    state = Column(String(16), default=PENDING)
+    params = Column(Text)
+    chunk_size = Column(Integer)
+    concurrency = Column(Integer, default=1)
+    total = Column(Integer)
+    processed = Column(Integer, default=0)
+    cancel_requested = Column(Boolean, default=False)
+    error = Column(Text)
+    started = Column(DateTime)
+    finished = Column(DateTime)
+    # The runner that claimed the job, and when its workers last
+    # checkpointed. Another runner may claim a running job whose heartbeat
+    # is older than JOB_STALE_AFTER.
+    owner = Column(String(128))
+    heartbeat = Column(DateTime)
+    ranges = relationship('JobRange', order_by='JobRange.id', backref='job')
+
+    def __init__(self, kind, chunk_size, params=None, concurrency=1):
+        """Initialize instance."""
+        self.kind = kind
+        self.chunk_size = chunk_size
+        self.params = ujson.dumps(params or {})
+        self.concurrency = concurrency
+        self.state = self.PENDING
+        self.processed = 0
+        self.cancel_requested = False
+
+    def __repr__(self):
+        """Human readable representation."""
+        fmt = '<%s(id=%s, kind=%s, state=%s, processed=%s) %s>'
+        return fmt % (self.__class__.__name__, self.id, self.kind,
+                      self.state, self.processed, hex(id(self)))
+
+    def to_dict(self):
+        """Serialize to a dict, including the job's throughput."""
+        elapsed = None
+        rate = None
+        if self.started is not None:
+            elapsed = ((self.finished or datetime.utcnow()) -
+                       self.started).total_seconds()
+            if elapsed > 0:
+                rate = (self.processed or 0) / elapsed
+
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'state': self.state,
+            'params': ujson.loads(self.params or '{}'),
+            'chunk_size': self.chunk_size,
+            'concurrency': self.concurrency,
+            'ranges': [job_range.to_dict() for job_range in self.ranges],
+            'total': self.total,
+            'processed': self.processed,
+            'cancel_requested': bool(self.cancel_requested),
+            'error': self.error,
+            'owner': self.owner,
+            'elapsed': elapsed,
+            'rate': rate,
+        }
+
+
+class JobRange(Base, BaseMixIn):
+    """A range of contact ids one of a job's workers processes."""
+    __tablename__ = 'job_ranges'
+
+    job_id = Column(Integer, ForeignKey('jobs.id'))
+    # The id of the last contact processed; the range resumes after it.
+    cursor = Column(Integer, default=0)
+    # The id of the range's last contact, or None for the last range, which
+    # also covers contacts added while the job runs.
+    last_id = Column(Integer)
+    done = Column(Boolean, default=False)
+
+    def __init__(self, cursor, last_id=None):
+        """Initialize instance."""
+        self.cursor = cursor
+        self.last_id = last_id
+        self.done = False
+
+    def to_dict(self):
+        """Serialize to a dict."""
+        return {
+            'cursor': self.cursor,
+            'last_id': self.last_id,
+            'done': bool(self.done),
+        }
+
+
+def _filter_contacts(query, contactmgr_id, filters=None):
+    """Restrict a query to a contact manager's contacts matching the given
+    filters.
+    """
+    query = query.filter(Contact.contactmgr_id == contactmgr_id)
+
+    for name, value in (filters or {}).items():
+        if name not in Contact.FILTERS:
+            raise ValueError('Unknown filter: %s' % name)
+        if name == 'state':
+            query = query.filter(Contact.state == value)
+        elif name == 'city':
+            query = query.filter(Contact.city == value)
+        elif name == 'zipcode_prefix':
+            escaped = value.replace('\\', '\\\\').replace(
+                '%', '\\%').replace('_', '\\_')
+            query = query.filter(
+                Contact.zipcode.like(escaped + '%', escape='\\'))
+
+    return query
+
+
+def query_contacts(session, contactmgr_id, sort=None, filters=None,
+                   limit=None, offset=0):
+    """Query a page of a contact manager's contacts, filtered and sorted by
+    one of the sortable fields. Prefix the sort field with '-' to sort
+    descending.
+    """
+    query = _filter_contacts(
+        session.query(Contact), contactmgr_id, filters)
+
+    descending = False
+    if sort:
+        descending = sort.startswith('-')
+        field = sort.lstrip('-')
+        if field not in Contact.SORTABLE:
+            raise ValueError('Unknown sort field: %s' % field)
+        column = getattr(Contact, field)
+        query = query.order_by(column.desc() if descending else column)
+
+    # Break ties in the direction of the sort so the index can be read
+    # backwards for descending sorts.
+    query = query.order_by(Contact.id.desc() if descending else Contact.id)
+    if offset:
+        query = query.offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def facet_counts(session, contactmgr_id, filters=None):
+    """Count a contact manager's contacts per state and per city within
+    each state from a single aggregate query.
+    """
+    query = _filter_contacts(
+        session.query(Contact.state, Contact.city, func.count()),
+        contactmgr_id, filters)
+    rows = query.group_by(Contact.state, Contact.city)
+
+    states = {}
+    cities = {}
+    for state, city, count in rows:
+        states[state] = states.get(state, 0) + count
+        cities.setdefault(state, {})[city] = count
+
+    return {'state': states, 'city': cities}
+
+
+def nearby_contacts(session, contactmgr_id, lat, lon, radius, limit=None,
+                    offset=0):
+    """Find a page of a contact manager's contacts within `radius` miles of a
+    point, returning (contact, distance) pairs, nearest first.
+
+    Only the ids and locations of the candidates are read to rank them, and
+    only the contacts of the page are loaded.
+    """
+    ranges = geo.cell_ranges(lat, lon, radius)
+    candidates = session.query(
+        Contact.id, Contact.latitude, Contact.longitude).filter(
+        Contact.contactmgr_id == contactmgr_id).filter(
+        or_(*[Contact.geocell.between(first, last)
+              for first, last in ranges])).all()
+    if not candidates:
+        return []
+
+    ids, lats, lons = zip(*candidates)
+    found = geo.nearest(lat, lon, radius, ids, lats, lons, limit=limit,
+                        offset=offset)
+    if not found:
+        return []
+
+    contacts = dict((contact.id, contact) for contact in session.query(
+        Contact).filter(Contact.id.in_([id_ for id_, _ in found])))
+    return [(contacts[id_], distance) for id_, distance in found]
+
+
 def init_model(engine=None):
     """Serialize the models into database tables."""
     Base.metadata.create_all(engine or get_engine())
 
 
+def backfill_locations(session, chunk_size=constants.BACKFILL_CHUNK_SIZE):
+    """Locate every contact from its ZIP code, committing a chunk of
+    contacts at a time.
+    """
+    cursor = 0
+    while True:
+        contacts = session.query(Contact).filter(
+            Contact.id > cursor).order_by(Contact.id).limit(chunk_size).all()
+        if not contacts:
+            return
+        for contact in contacts:
+            contact.locate()
+        cursor = contacts[-1].id
+        session.commit()
+
+
+def upgrade_model(engine=None):
+    """Bring tables made by an older `init_model` up to date: create new
+    tables, add the contacts columns and indexes they are missing and locate
+    the existing contacts if the location columns were just added.
+    """
+    engine = engine or get_engine()
+    init_model(engine)
+
+    inspector = inspect(engine)
+    columns = set(column['name'] for column in
+                  inspector.get_columns(Contact.__tablename__))
+    added = []
+    for column in Contact.__table__.columns:
+        if column.name not in columns:
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                Contact.__tablename__, column.name,
+                column.type.compile(dialect=engine.dialect)))
+            added.append(column.name)
+
+    indexes = set(index['name'] for index in
+                  inspector.get_indexes(Contact.__tablename__))
+    for index in Contact.__table__.indexes:
+        if index.name not in indexes:
+            index.create(engine)
+
+    if 'geocell' in added:
+        session = sessionmaker(bind=engine)()
+        try:
+            backfill_locations(session)
+        finally:
+            session.close()
+
+
 if __name__ == '__main__':
-    init_model()
+    upgrade_model()
@@ -0,0 +1,78 @@
+"""Coalesce concurrent identical reads into a single computation.
+
+The first caller for a key (the leader) runs the computation while every
+caller that arrives with the same key before it finishes (the followers) waits
+for and shares its result, or its exception. Nothing is cached once the
+computation finishes; the next caller for the key starts a new one.
+
+Coalescing is per process, which covers the threaded paste server and
+multi-threaded WSGI servers alike.
+"""
+
+import threading
+
+
+class Timeout(Exception):
+    """A follower gave up waiting on the leader's computation."""
+
+
+class _Call(object):
+    """An in-flight computation shared by the callers of one key."""
+
+    def __init__(self):
+        """Initialize instance."""
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight(object):
+    """A registry of in-flight computations keyed by request identity."""
+
+    def __init__(self):
+        """Initialize instance."""
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, timeout=None):
+        """Run `func` for `key`, or wait up to `timeout` seconds for the
+        result of the call already running it.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                call.followers += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = func()
+            except Exception as err:
+                call.error = err
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.result
+
+        if not call.done.wait(timeout):
+            raise Timeout('Timed out waiting on %r' % (key,))
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def in_flight(self):
+        """The number of computations currently running."""
+        with self._lock:
+            return len(self._calls)
+
+    def followers(self, key):
+        """The number of callers waiting on the computation for `key`."""
+        with self._lock:
+            call = self._calls.get(key)
+            return 0 if call is None else call.followers
@@ -0,0 +1,147 @@
+"""Server side validation and normalization of contacts before they are
+written to the database.
+
+A `ContactSchema` is built once per model, deriving its length limits from
+the model's column definitions, and validates a whole batch of contacts in a
+single pass so that every bad row can be reported at once and nothing is
+written unless the entire batch is good.
+"""
+
+import re
+
+
+ID_RE = re.compile(r'^-?\d+$')
+ZIPCODE_RE = re.compile(r'^\d{5}(?:-\d{4})?$')
+STATE_RE = re.compile(r'^[A-Z]{2}$')
+WHITESPACE_RE = re.compile(r'\s+')
+
+# The id the frontend gives to contacts that haven't been saved yet.
+NEW_ID = -1
+
+# The cells of a row in the frontend's contacts table.
+TABLE_ROW_FIELDS = (
+    None, 'id', 'firstname', 'lastname', 'zipcode', 'city', 'state')
+
+
+class ValidationError(Exception):
+    """A batch of contacts failed validation.
+
+    `errors` maps the index of each bad row to a dict of field -> message.
+    """
+
+    def __init__(self, errors):
+        """Initialize instance."""
+        super(ValidationError, self).__init__(
+            '%d invalid contact(s)' % len(errors))
+        self.errors = errors
+
+
+class ContactSchema(object):
+    """Validates and normalizes batches of contact fields."""
+
+    REQUIRED = ('firstname', 'lastname', 'zipcode')
+
+    def __init__(self, model):
+        """Derive the fields and their length limits from a model's String
+        columns.
+        """
+        self.max_lengths = {}
+        for column in model.__table__.columns:
+            length = getattr(column.type, 'length', None)
+            if length is not None:
+                self.max_lengths[column.name] = length
+        self.fields = tuple(
+            field for field in TABLE_ROW_FIELDS[2:]
+            if field in self.max_lengths)
+
+    def normalize(self, field, value):
+        """Normalize a single value: collapse whitespace and fix the case of
+        fields that have a canonical case.
+        """
+        if value is None:
+            return ''
+        value = WHITESPACE_RE.sub(' ', u'%s' % value).strip()
+        if field == 'state':
+            value = value.upper()
+        elif field == 'zipcode':
+            value = value.replace(' ', '')
+        return value
+
+    def _check(self, field, value):
+        """Return an error message for a normalized value, or None."""
+        if not value:
+            if field in self.REQUIRED:
+                return 'is required'
+            return None
+        if len(value) > self.max_lengths[field]:
+            return 'must be at most %d characters' % self.max_lengths[field]
+        if field == 'zipcode' and not ZIPCODE_RE.match(value):
+            return 'must be a ZIP or ZIP+4 code'
+        if field == 'state' and not STATE_RE.match(value):
+            return 'must be a two letter state abbreviation'
+        return None
+
+    def validate(self, records):
+        """Validate a batch of dicts of field -> value, returning the
+        normalized dicts or raising a ValidationError for every bad row.
+
+        Each dict may carry an `id`, which is coerced to an int and is
+        NEW_ID for contacts that don't exist yet.
+        """
+        cleaned = []
+        errors = {}
+
+        for index, record in enumerate(records):
+            row_errors = {}
+            row = {}
+
+            id_ = u'%s' % record.get('id', NEW_ID)
+            if ID_RE.match(id_.strip()):
+                row['id'] = int(id_)
+            else:
+                row_errors['id'] = 'must be an integer'
+
+            for field in self.fields:
+                value = self.normalize(field, record.get(field))
+                message = self._check(field, value)
+                if message is None:
+                    row[field] = value
+                else:
+                    row_errors[field] = message
+
+            if row_errors:
+                errors[index] = row_errors
+            cleaned.append(row)
+
+        if errors:
+            raise ValidationError(errors)
+        return cleaned
+
+    def validate_table_rows(self, rows):
+        """Validate the rows POSTed from the frontend's contacts table, where
+        each row is the list of its cells' contents.
+        """
+        if not isinstance(rows, list):
+            raise ValidationError({'rows': 'must be a list of rows'})
+
+        records = []
+        errors = {}
+        for index, row in enumerate(rows):
+            if (not isinstance(row, (list, tuple)) or
+                    len(row) != len(TABLE_ROW_FIELDS)):
+                errors[index] = {
+                    'row': 'must have %d cells' % len(TABLE_ROW_FIELDS)}
+                records.append({})
+            else:
+                records.append(dict(zip(TABLE_ROW_FIELDS[1:], row[1:])))
+
+        try:
+            cleaned = self.validate(records)
+        except ValidationError as err:
+            for index, row_errors in err.errors.items():
+                errors.setdefault(index, row_errors)
+            raise ValidationError(errors)
+
+        if errors:
+            raise ValidationError(errors)
+        return cleaned
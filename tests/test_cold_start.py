@@ -0,0 +1,84 @@
+"""Test suite guarding the cold start time of the contact_manager app."""
+
+import os
+import subprocess
+import sys
+import unittest
+
+import ujson
+
+
+# The modules the app can't start without. Importing them in a fresh
+# interpreter is the baseline the app's own import time is measured against.
+DEPENDENCIES = ('webapp2', 'ujson')
+
+# Seconds importing src.contact_manager may take on top of its dependencies.
+# Importing SQLAlchemy's ORM or jinja2 up front costs several times this.
+IMPORT_OVERHEAD_BUDGET = 0.05
+
+# Modules that should only be imported on first use.
+DEFERRED_MODULES = ('sqlalchemy', 'jinja2', 'paste.httpserver')
+
+# Each import is timed in this many fresh interpreters and the fastest run
+# is kept, which filters out most of the noise of a busy machine.
+RUNS = 3
+
+PROFILE = '''
+import sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+modules = sorted(sys.modules)
+from src import models
+import ujson
+sys.stdout.write(ujson.dumps({
+    'elapsed': elapsed,
+    'modules': modules,
+    'engine': models._ENGINE is not None,
+}))
+'''
+
+
+def _profile(modules):
+    """Import modules in fresh interpreters, returning the fastest run's
+    import time, loaded modules and whether an engine was created.
+    """
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    profiles = []
+    for _ in range(RUNS):
+        output = subprocess.check_output(
+            [sys.executable, '-c', PROFILE % ', '.join(modules)], cwd=root)
+        profiles.append(ujson.loads(output))
+    return min(profiles, key=lambda profile: profile['elapsed'])
+
+
+class TestColdStart(unittest.TestCase):
+    """Profile importing the app in fresh interpreters."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Import the app and, for a baseline, its dependencies alone."""
+        cls.baseline = _profile(DEPENDENCIES)
+        cls.profile = _profile(('src.contact_manager',))
+
+    def test_import_budget(self):
+        """Importing the app costs little more than its dependencies."""
+        overhead = self.profile['elapsed'] - self.baseline['elapsed']
+        self.assertTrue(
+            overhead < IMPORT_OVERHEAD_BUDGET,
+            'Importing took %.3fs, %.3fs more than its dependencies; the '
+            'budget is %.3fs' % (self.profile['elapsed'], overhead,
+                                 IMPORT_OVERHEAD_BUDGET))
+
+    def test_deferred_imports(self):
+        """Rarely used and expensive modules aren't imported until they are
+        needed.
+        """
+        modules = set(self.profile['modules'])
+        for module in DEFERRED_MODULES + ('src.models',):
+            self.assertFalse(
+                module in modules, '%s was imported eagerly' % module)
+
+    def test_lazy_engine(self):
+        """The engine isn't created at import time."""
+        self.assertFalse(self.profile['engine'])
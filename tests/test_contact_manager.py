@@ -1,5 +1,7 @@
 """Test suite for the contact_manager.py webapp2 app."""
 
+import gzip
+import io
 import unittest
 
 from sqlalchemy import create_engine
@@ -8,7 +10,9 @@ import ujson
 import webapp2
 
 from src import common
+from src import constants
 from src import contact_manager
+from src import jobs
 from src import models
 
 
@@ -72,7 +76,7 @@ class TestContactManager(CommonFixture):
         """
         self.request.method = 'POST'
         self.request.body = ujson.dumps([
-            ['', '-1', 'f1', 'l1', 'z1', 'c1', 's1'],
+            ['', '-1', 'f1', 'l1', '28401', 'c1', 'NC'],
         ])
         response = self._get_response()
 
@@ -86,13 +90,13 @@ class TestContactManager(CommonFixture):
         """
         self.request.method = 'POST'
         self.request.body = ujson.dumps([
-            ['', '-1', 'f1', 'l1', 'z1', 'c1', 's1'],
+            ['', '-1', 'f1', 'l1', '28401', 'c1', 'NC'],
         ])
         response = self._get_response()
 
         self.request.body = ujson.dumps([
-            ['', '1', 'f1', 'l1', 'z1', 'c1', 's1'],
-            ['', '-1', 'f2', 'l2', 'z2', 'c2', 's2'],
+            ['', '1', 'f1', 'l1', '28401', 'c1', 'NC'],
+            ['', '-1', 'f2', 'l2', '28402', 'c2', 'NC'],
         ])
         response = self._get_response()
 
@@ -106,8 +110,8 @@ class TestContactManager(CommonFixture):
         """
         self.request.method = 'POST'
         self.request.body = ujson.dumps([
-            ['', '-1', 'f1', 'l1', 'z1', 'c1', 's1'],
-            ['', '-1', 'f2', 'l2', 'z2', 'c2', 's2'],
+            ['', '-1', 'f1', 'l1', '28401', 'c1', 'NC'],
+            ['', '-1', 'f2', 'l2', '28402', 'c2', 'NC'],
         ])
         response = self._get_response()
 
@@ -116,11 +120,11 @@ class TestContactManager(CommonFixture):
             response.body, ujson.dumps({'modified': [], 'created': [1, 2]}))
 
         self.request.body = ujson.dumps([
-            ['', '1', 'f1', 'l1', 'z1', 'c1', 's1'],
-            ['', '2', 'f2', 'l2', 'z2', 'c2', 's2'],
-            ['', '-1', 'f3', 'l3', 'z3', 'c3', 's3'],
-            ['', '-1', 'f4', 'l4', 'z4', 'c4', 's4'],
-            ['', '-1', 'f5', 'l5', 'z5', 'c5', 's5'],
+            ['', '1', 'f1', 'l1', '28401', 'c1', 'NC'],
+            ['', '2', 'f2', 'l2', '28402', 'c2', 'NC'],
+            ['', '-1', 'f3', 'l3', '28403', 'c3', 'NC'],
+            ['', '-1', 'f4', 'l4', '28404', 'c4', 'NC'],
+            ['', '-1', 'f5', 'l5', '28405', 'c5', 'NC'],
         ])
         response = self._get_response()
 
@@ -129,10 +133,145 @@ class TestContactManager(CommonFixture):
             response.body,
             ujson.dumps({'modified': [1, 2], 'created': [3, 4, 5]}))
 
+    def test_post_invalid(self):
+        """POSTing a batch with a bad row should save nothing and report the
+        errors of each bad row.
+        """
+        self.request.method = 'POST'
+        self.request.body = ujson.dumps([
+            ['', '-1', 'f1', 'l1', '28401', 'c1', 'NC'],
+            ['', '-1', '', 'l2', 'nope', 'c2', 'NC'],
+        ])
+        response = self._get_response()
+
+        self.assertEqual(response.status_int, 400)
+        self.assertEqual(
+            ujson.loads(response.body),
+            {'errors': {'1': {'firstname': 'is required',
+                              'zipcode': 'must be a ZIP or ZIP+4 code'}}})
+        self.assertEqual(self.session.query(models.Contact).count(), 0)
+
     def test_get(self):
         """GETing the cmgr resource should result in all contacts."""
         self.request.method = 'POST'
 
+    def _add_contacts(self, count):
+        """Save a contact manager with `count` contacts."""
+        contactmgr = models.ContactManager(contacts=[
+            models.Contact('f%s' % i, 'l%s' % i, '2840%s' % i, 'c%s' % i,
+                           'NC')
+            for i in range(count)])
+        self.session.add(contactmgr)
+        self.session.commit()
+        return contactmgr
+
+    def test_get__dict(self):
+        """GETing the cmgr resource defaults to a list of contact dicts."""
+        contactmgr = self._add_contacts(2)
+
+        response = self._get_response()
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(
+            ujson.loads(response.body),
+            {'contacts': [c.to_dict() for c in contactmgr.contacts],
+             'next_offset': None})
+
+    def test_get__paged(self):
+        """The listing is paged with limit and offset."""
+        self._add_contacts(5)
+
+        self.request = webapp2.Request.blank('/cmgr?limit=2&offset=2')
+        json = ujson.loads(self._get_response().body)
+        self.assertEqual(
+            [contact['firstname'] for contact in json['contacts']],
+            ['f2', 'f3'])
+        self.assertEqual(json['next_offset'], 4)
+
+        self.request = webapp2.Request.blank('/cmgr?limit=2&offset=4')
+        json = ujson.loads(self._get_response().body)
+        self.assertEqual(len(json['contacts']), 1)
+        self.assertEqual(json['next_offset'], None)
+
+    def test_get__bad_limit(self):
+        """Limits outside of the page size bounds are bad requests."""
+        for query in ('limit=0', 'limit=100000', 'limit=x', 'offset=-1'):
+            self.request = webapp2.Request.blank('/cmgr?%s' % query)
+            self.assertEqual(self._get_response().status_int, 400)
+
+    def test_get__columnar(self):
+        """The columnar format sends the field names once."""
+        contactmgr = self._add_contacts(2)
+
+        self.request = webapp2.Request.blank('/cmgr?format=columnar')
+        response = self._get_response()
+
+        contact = contactmgr.contacts[0]
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(
+            ujson.loads(response.body)['contacts']['fields'],
+            list(models.Contact.FIELDS))
+        self.assertEqual(
+            ujson.loads(response.body)['contacts']['rows'][0],
+            [contact.id, 'f0', 'l0', '28400', 'c0', 'NC'])
+
+    def test_get__sort_filter_facets(self):
+        """The listing can be sorted, filtered and faceted."""
+        self._add_contacts(3)
+
+        self.request = webapp2.Request.blank(
+            '/cmgr?sort=-firstname&zipcode_prefix=284&facets=1')
+        response = self._get_response()
+
+        json = ujson.loads(response.body)
+        self.assertEqual(
+            [contact['firstname'] for contact in json['contacts']],
+            ['f2', 'f1', 'f0'])
+        self.assertEqual(json['facets']['state'], {'NC': 3})
+
+    def test_get__normalized_filters(self):
+        """Filter values are normalized like the stored values."""
+        self._add_contacts(2)
+
+        self.request = webapp2.Request.blank(
+            '/cmgr?state=%20nc&zipcode_prefix=2840%200')
+        response = self._get_response()
+
+        json = ujson.loads(response.body)
+        self.assertEqual(
+            [contact['firstname'] for contact in json['contacts']], ['f0'])
+
+    def test_get__bad_sort(self):
+        """Sorting by an unknown field is a bad request."""
+        self.request = webapp2.Request.blank('/cmgr?sort=nope')
+        response = self._get_response()
+
+        self.assertEqual(response.status_int, 400)
+
+    def test_get__gzip(self):
+        """Large responses are gzipped when the client accepts it."""
+        self._add_contacts(50)
+
+        self.request.headers['Accept-Encoding'] = 'gzip, deflate'
+        response = self._get_response()
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertGreater(len(response.body), 0)
+        body = gzip.GzipFile(fileobj=io.BytesIO(response.body)).read()
+        self.assertEqual(len(ujson.loads(body)['contacts']), 50)
+
+    def test_get__below_threshold(self):
+        """Small responses are not compressed."""
+        self._add_contacts(1)
+
+        self.request.headers['Accept-Encoding'] = 'gzip'
+        response = self._get_response()
+
+        self.assertTrue(len(response.body) < constants.COMPRESSION_MIN_SIZE)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['Vary'], 'Accept, Accept-Encoding')
+
     def test_delete_0contact(self):
         """Using the DELETE resource with no valid data shouldn't blow up."""
         self.request.method = 'DELETE'
@@ -145,9 +284,9 @@ class TestContactManager(CommonFixture):
         """
         contactmgr = models.ContactManager(
             contacts=[
-                models.Contact('f1', 'l1', 'z1', 'c1', 's1'),
-                models.Contact('f2', 'l2', 'z2', 'c2', 's2'),
-                models.Contact('f3', 'l3', 'z3', 'c3', 's3'),
+                models.Contact('f1', 'l1', '28401', 'c1', 'NC'),
+                models.Contact('f2', 'l2', '28402', 'c2', 'NC'),
+                models.Contact('f3', 'l3', '28403', 'c3', 'NC'),
             ]
         )
 
@@ -181,9 +320,9 @@ class TestContactManager(CommonFixture):
         """
         contactmgr = models.ContactManager(
             contacts=[
-                models.Contact('f1', 'l1', 'z1', 'c1', 's1'),
-                models.Contact('f2', 'l2', 'z2', 'c2', 's2'),
-                models.Contact('f3', 'l3', 'z3', 'c3', 's3'),
+                models.Contact('f1', 'l1', '28401', 'c1', 'NC'),
+                models.Contact('f2', 'l2', '28402', 'c2', 'NC'),
+                models.Contact('f3', 'l3', '28403', 'c3', 'NC'),
             ]
         )
 
@@ -210,3 +349,159 @@ class TestContactManager(CommonFixture):
                 models.Contact).filter(models.Contact.id == id_remaining
                 ).all()),
             1)
+
+
+class TestContactNearby(CommonFixture):
+    """Tests for the ContactNearby proximity search request handler."""
+
+    def setUp(self):
+        """Initialize test fixture."""
+        super(TestContactNearby, self).setUp()
+        engine = create_engine('sqlite:///:memory:', echo=True)
+        self.session = sessionmaker(bind=engine)()
+        models.init_model(engine)
+        contact_manager.APP.engine = engine
+
+        self.session.add(models.ContactManager(contacts=[
+            models.Contact('f1', 'l1', '28409', 'Wilmington', 'NC'),
+            models.Contact('f2', 'l2', '90210', 'Beverly Hills', 'CA'),
+        ]))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_get(self):
+        """Contacts within the radius are returned with their distance."""
+        self.request = webapp2.Request.blank(
+            '/cmgr/nearby?zip=28403&radius=25')
+        response = self._get_response()
+
+        self.assertEqual(response.status_int, 200)
+        contacts = ujson.loads(response.body)['contacts']
+        self.assertEqual([c['firstname'] for c in contacts], ['f1'])
+        self.assertTrue(0 < contacts[0]['distance'] < 25)
+
+    def test_get__paged(self):
+        """The results are paged like the contacts listing."""
+        contactmgr = self.session.query(models.ContactManager).one()
+        contactmgr.contacts.append(
+            models.Contact('f3', 'l3', '28401', 'Wilmington', 'NC'))
+        self.session.commit()
+
+        self.request = webapp2.Request.blank(
+            '/cmgr/nearby?zip=28403&radius=25&limit=1')
+        json = ujson.loads(self._get_response().body)
+        self.assertEqual([c['firstname'] for c in json['contacts']], ['f1'])
+        self.assertEqual(json['next_offset'], 1)
+
+        self.request = webapp2.Request.blank(
+            '/cmgr/nearby?zip=28403&radius=25&limit=1&offset=1')
+        json = ujson.loads(self._get_response().body)
+        self.assertEqual([c['firstname'] for c in json['contacts']], ['f3'])
+        self.assertEqual(json['next_offset'], None)
+
+    def test_get__bad_page(self):
+        """The page must be in range."""
+        self.request = webapp2.Request.blank(
+            '/cmgr/nearby?zip=28403&radius=25&limit=0')
+        self.assertEqual(self._get_response().status_int, 400)
+
+    def test_get__unknown_zip(self):
+        """Searching around an unknown ZIP code is a bad request."""
+        self.request = webapp2.Request.blank('/cmgr/nearby?zip=nope&radius=5')
+        self.assertEqual(self._get_response().status_int, 400)
+
+    def test_get__bad_radius(self):
+        """The radius must be a positive number of miles."""
+        for radius in ('', 'x', '-1', '100000'):
+            self.request = webapp2.Request.blank(
+                '/cmgr/nearby?zip=28403&radius=%s' % radius)
+            self.assertEqual(self._get_response().status_int, 400)
+
+
+class TestJobs(CommonFixture):
+    """Tests for the Jobs and JobStatus request handlers."""
+
+    def setUp(self):
+        """Initialize test fixture, running jobs inline."""
+        super(TestJobs, self).setUp()
+        engine = create_engine('sqlite:///:memory:', echo=True)
+        self.session = sessionmaker(bind=engine)()
+        models.init_model(engine)
+        contact_manager.APP.engine = engine
+        self.job_runner = contact_manager.APP.job_runner
+        contact_manager.APP.job_runner = jobs.JobRunner(processes=0)
+
+        self.session.add(models.ContactManager(contacts=[
+            models.Contact('f1', 'l1', '28409', 'c1', 'nc'),
+        ]))
+        self.session.commit()
+
+    def tearDown(self):
+        contact_manager.APP.job_runner = self.job_runner
+        self.session.close()
+
+    def test_post(self):
+        """POSTing a job runs it and reports on it."""
+        self.request = webapp2.Request.blank('/jobs')
+        self.request.method = 'POST'
+        self.request.body = ujson.dumps(
+            {'kind': 'normalize', 'concurrency': 2})
+        response = self._get_response()
+
+        self.assertEqual(response.status_int, 202)
+        job = ujson.loads(response.body)
+        self.assertEqual(job['concurrency'], 2)
+        self.assertEqual(response.headers['Location'],
+                         self.request.host_url + '/jobs/%s' % job['id'])
+
+        self.request = webapp2.Request.blank('/jobs/%s' % job['id'])
+        job = ujson.loads(self._get_response().body)
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(job['processed'], 1)
+        self.assertEqual(self.session.query(models.Contact).one().state, 'NC')
+
+    def test_post__not_started(self):
+        """A job POSTed while the job runner isn't started stays pending."""
+        contact_manager.APP.job_runner = jobs.JobRunner(processes=1)
+
+        self.request = webapp2.Request.blank('/jobs')
+        self.request.method = 'POST'
+        self.request.body = ujson.dumps({'kind': 'normalize'})
+        response = self._get_response()
+
+        self.assertEqual(response.status_int, 202)
+        self.assertEqual(ujson.loads(response.body)['state'], 'pending')
+
+    def test_post__bad_concurrency(self):
+        """The concurrency must be in range."""
+        self.request = webapp2.Request.blank('/jobs')
+        self.request.method = 'POST'
+        self.request.body = ujson.dumps(
+            {'kind': 'normalize', 'concurrency': 0})
+        self.assertEqual(self._get_response().status_int, 400)
+
+    def test_post__bad_kind(self):
+        """Unknown kinds of jobs are bad requests."""
+        self.request = webapp2.Request.blank('/jobs')
+        self.request.method = 'POST'
+        self.request.body = ujson.dumps({'kind': 'nope'})
+        self.assertEqual(self._get_response().status_int, 400)
+
+    def test_get__missing(self):
+        """Unknown jobs are not found."""
+        self.request = webapp2.Request.blank('/jobs/42')
+        self.assertEqual(self._get_response().status_int, 404)
+
+    def test_delete(self):
+        """DELETEing a job requests its cancellation."""
+        job = models.Job('normalize', 10)
+        self.session.add(job)
+        self.session.commit()
+
+        self.request = webapp2.Request.blank('/jobs/%s' % job.id)
+        self.request.method = 'DELETE'
+        response = self._get_response()
+
+        self.assertTrue(ujson.loads(response.body)['cancel_requested'])
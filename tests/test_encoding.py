@@ -0,0 +1,124 @@
+"""Test suite for encoding.py's content negotiation and compression."""
+
+import unittest
+import zlib
+
+import webapp2
+
+from src import encoding
+
+
+class TestNegotiateEncoding(unittest.TestCase):
+    """Tests for picking a content coding from Accept-Encoding."""
+
+    def setUp(self):
+        """Pretend brotli isn't installed so the results are predictable."""
+        self._brotli = encoding.brotli
+        encoding.brotli = None
+
+    def tearDown(self):
+        """Restore the brotli module."""
+        encoding.brotli = self._brotli
+
+    def test_no_header(self):
+        """No Accept-Encoding means no compression."""
+        self.assertEqual(encoding.negotiate_encoding(None), None)
+
+    def test_gzip(self):
+        """gzip is preferred over deflate when both are equal."""
+        self.assertEqual(
+            encoding.negotiate_encoding('deflate, gzip'), 'gzip')
+
+    def test_qvalues(self):
+        """The coding with the highest q value wins."""
+        self.assertEqual(
+            encoding.negotiate_encoding('gzip;q=0.5, deflate'), 'deflate')
+
+    def test_refused(self):
+        """q=0 refuses a coding, even with a wildcard."""
+        self.assertEqual(
+            encoding.negotiate_encoding('gzip;q=0, deflate;q=0, *'), None)
+
+    def test_unsupported(self):
+        """Codings we can't produce are ignored."""
+        self.assertEqual(encoding.negotiate_encoding('compress'), None)
+
+
+class TestNegotiateFormat(unittest.TestCase):
+    """Tests for picking the body format."""
+
+    def _negotiate(self, accept, url='/cmgr'):
+        """Negotiate the format of a request with an Accept header."""
+        request = webapp2.Request.blank(url)
+        if accept is not None:
+            request.headers['Accept'] = accept
+        return encoding.negotiate_format(request)
+
+    def test_default(self):
+        """Plain JSON is the default."""
+        self.assertEqual(self._negotiate(None), encoding.FORMAT_DICT)
+        self.assertEqual(self._negotiate('*/*'), encoding.FORMAT_DICT)
+
+    def test_columnar(self):
+        """The columnar media type selects the columnar format."""
+        self.assertEqual(
+            self._negotiate('application/vnd.cmgr.columnar+json'),
+            encoding.FORMAT_COLUMNAR)
+        self.assertEqual(
+            self._negotiate('application/json;q=0.5, '
+                            'application/vnd.cmgr.columnar+json'),
+            encoding.FORMAT_COLUMNAR)
+
+    def test_qvalues(self):
+        """q=0 refuses the columnar format and a lower q loses to JSON."""
+        self.assertEqual(
+            self._negotiate('application/vnd.cmgr.columnar+json;q=0, */*'),
+            encoding.FORMAT_DICT)
+        self.assertEqual(
+            self._negotiate('application/vnd.cmgr.columnar+json;q=0.5, '
+                            'application/json'),
+            encoding.FORMAT_DICT)
+
+    def test_query_parameter(self):
+        """The format query parameter overrides the Accept header."""
+        self.assertEqual(
+            self._negotiate('application/vnd.cmgr.columnar+json',
+                            url='/cmgr?format=dict'),
+            encoding.FORMAT_DICT)
+
+
+class TestAddVary(unittest.TestCase):
+    """Tests for adding to the Vary header."""
+
+    def test_add_vary(self):
+        """Headers are appended once, keeping the existing ones."""
+        response = webapp2.Response()
+        response.headers['Vary'] = 'Cookie, accept'
+        encoding.add_vary(response, 'Accept', 'Accept-Encoding')
+        self.assertEqual(
+            response.headers['Vary'], 'Cookie, accept, Accept-Encoding')
+
+
+class TestCompress(unittest.TestCase):
+    """Tests for compressing bodies."""
+
+    def test_deflate(self):
+        """deflate round trips through zlib."""
+        body = b'{"a": 1}' * 100
+        self.assertEqual(
+            zlib.decompress(encoding.compress(body, 'deflate')), body)
+
+    def test_unsupported(self):
+        """Unknown codings are an error."""
+        self.assertRaises(ValueError, encoding.compress, b'', 'compress')
+
+
+class TestToColumnar(unittest.TestCase):
+    """Tests for the columnar format."""
+
+    def test_to_columnar(self):
+        """Field names are sent once, followed by rows of values."""
+        dicts = [{'a': 1, 'b': 2}, {'a': 3, 'b': 4}]
+        self.assertEqual(
+            encoding.to_columnar(dicts, ('a', 'b')),
+            {'fields': ['a', 'b'], 'rows': [[1, 2], [3, 4]]})
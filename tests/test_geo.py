@@ -0,0 +1,117 @@
+"""Test suite for geo.py's ZIP geolocation and grid helpers."""
+
+import unittest
+
+from src import constants
+from src import geo
+
+
+class TestLocate(unittest.TestCase):
+    """Tests for looking up ZIP centroids."""
+
+    def test_known(self):
+        """Known ZIP and ZIP+4 codes map to their centroid."""
+        lat, lon = geo.locate('28409')
+        self.assertAlmostEqual(lat, 34.15, places=1)
+        self.assertAlmostEqual(lon, -77.87, places=1)
+        self.assertEqual(geo.locate('28409-1234'), (lat, lon))
+
+    def test_coverage(self):
+        """Every ZIP5 is bundled, PO box and unique ZIPs included."""
+        self.assertTrue(len(geo.CENTROIDS.get()) > 40000)
+        self.assertNotEqual(geo.locate('00501'), None)
+        self.assertNotEqual(geo.locate('99950'), None)
+
+    def test_unknown(self):
+        """Unknown ZIP codes aren't located."""
+        self.assertEqual(geo.locate('00000'), None)
+        self.assertEqual(geo.locate(''), None)
+
+
+class TestGrid(unittest.TestCase):
+    """Tests for bucketing points into grid cells."""
+
+    def test_cell(self):
+        """Cells are numbered row by row from the south west."""
+        self.assertEqual(geo.cell(-90.0, -180.0), 0)
+        self.assertEqual(geo.cell(-90.0, -180.0 + constants.GEO_CELL_DEGREES),
+                         1)
+        self.assertEqual(geo.cell(-90.0 + constants.GEO_CELL_DEGREES, -180.0),
+                         geo.GRID_COLS)
+
+    def _covered(self, center, point, radius):
+        """Whether a point's cell is covered by the ranges for a radius."""
+        target = geo.cell(*point)
+        return any(first <= target <= last for first, last in
+                   geo.cell_ranges(center[0], center[1], radius))
+
+    def test_cell_ranges(self):
+        """A radius covers the cells of the points within it."""
+        # Raleigh is ~110 miles from Wilmington, Atlanta ~330.
+        wilmington = (34.15, -77.87)
+        self.assertTrue(self._covered(wilmington, (35.77, -78.63), 150))
+        self.assertFalse(self._covered(wilmington, (33.75, -84.39), 150))
+
+    def test_cell_ranges__few(self):
+        """A small radius is covered by a few range scans."""
+        self.assertTrue(len(geo.cell_ranges(34.15, -77.87, 10)) <= 2)
+
+    def test_cell_ranges__antimeridian(self):
+        """Radii that wrap around the antimeridian cover both sides."""
+        self.assertTrue(self._covered((0.0, 179.9), (0.0, -179.9), 50))
+        self.assertTrue(self._covered((0.0, -179.9), (0.0, 179.9), 50))
+        self.assertFalse(self._covered((0.0, 179.9), (0.0, 0.0), 50))
+
+
+class TestDistances(unittest.TestCase):
+    """Tests for the haversine distances."""
+
+    def test_distances(self):
+        """Distances match known great circle distances."""
+        # New York to Los Angeles is ~2,450 miles.
+        nyc, la = geo.locate('10001'), geo.locate('90012')
+        distances = geo.distances(nyc[0], nyc[1], [nyc[0], la[0]],
+                                  [nyc[1], la[1]])
+        self.assertAlmostEqual(distances[0], 0.0)
+        self.assertTrue(2400 < distances[1] < 2500)
+
+    def test_fallback(self):
+        """The pure Python fallback agrees with the vectorized version."""
+        self.assertAlmostEqual(
+            geo.distances(34.15, -77.87, [35.77], [-78.63])[0],
+            geo._haversine(34.15, -77.87, 35.77, -78.63))
+
+
+class TestNearest(unittest.TestCase):
+    """Tests for ranking points by distance."""
+
+    # Two points share a location, as contacts with the same ZIP code do.
+    IDS = [4, 3, 2, 1]
+    LATS = [35.77, 34.24, 34.24, 34.0]
+    LONS = [-78.63, -77.95, -77.95, -118.25]
+
+    def _nearest(self, radius, **kwargs):
+        """Rank the points around Wilmington, NC."""
+        return [id_ for id_, _ in geo.nearest(
+            34.2, -77.9, radius, self.IDS, self.LATS, self.LONS, **kwargs)]
+
+    def test_nearest(self):
+        """Points within the radius come nearest first, then by id."""
+        self.assertEqual(self._nearest(150), [2, 3, 4])
+        self.assertEqual(self._nearest(10), [2, 3])
+
+    def test_page(self):
+        """A page of the ranked points is returned."""
+        self.assertEqual(self._nearest(150, limit=2), [2, 3])
+        self.assertEqual(self._nearest(150, limit=2, offset=2), [4])
+        self.assertEqual(self._nearest(150, offset=3), [])
+
+    def test_fallback(self):
+        """The pure Python fallback ranks the points the same way."""
+        numpy = geo._numpy
+        geo._numpy = lambda: None
+        try:
+            self.assertEqual(self._nearest(150), [2, 3, 4])
+            self.assertEqual(self._nearest(150, limit=1, offset=1), [3])
+        finally:
+            geo._numpy = numpy
@@ -0,0 +1,282 @@
+"""Test suite for jobs.py's background job runner and tasks."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from src import constants
+from src import jobs
+from src import models
+
+
+class CommonFixture(unittest.TestCase):
+    """Common fixtures used in the tests."""
+
+    def setUp(self):
+        """Initialize a fresh in-memory DB with some contacts."""
+        self.engine = create_engine('sqlite:///:memory:', echo=True)
+        self.session = sessionmaker(bind=self.engine)()
+        models.init_model(self.engine)
+
+        self.contactmgr = models.ContactManager(contacts=[
+            models.Contact('f%s' % i, 'l%s' % i, '28409', 'c', 'NC')
+            for i in range(5)])
+        self.session.add(self.contactmgr)
+        self.session.commit()
+
+    def tearDown(self):
+        """Clobber the session."""
+        self.session.close()
+
+    def _run(self, kind, chunk_size=2, ranges=(), **kwargs):
+        """Create and run a job inline, returning it reloaded."""
+        job = models.Job(kind, chunk_size)
+        for name, value in kwargs.items():
+            setattr(job, name, value)
+        job.ranges = list(ranges)
+        self.session.add(job)
+        self.session.commit()
+
+        jobs.JobRunner(processes=0).submit(job.id, self.engine)
+
+        self.session.expire_all()
+        return self.session.query(models.Job).get(job.id)
+
+
+class TestRunJob(CommonFixture):
+    """Tests for processing jobs chunk by chunk."""
+
+    def test_done(self):
+        """A job processes every contact and records its throughput."""
+        job = self._run('relocate')
+
+        self.assertEqual(job.state, models.Job.DONE)
+        self.assertEqual(job.total, 5)
+        self.assertEqual(job.processed, 5)
+        self.assertEqual([job_range.cursor for job_range in job.ranges],
+                         [self.contactmgr.contacts[-1].id])
+        self.assertNotEqual(job.to_dict()['elapsed'], None)
+
+    def test_concurrency(self):
+        """A job's contacts are split into ranges of about the same size."""
+        ids = [contact.id for contact in self.contactmgr.contacts]
+        job = self._run('relocate', concurrency=2)
+
+        self.assertEqual(job.state, models.Job.DONE)
+        self.assertEqual(job.processed, 5)
+        self.assertEqual(
+            [(job_range.last_id, job_range.cursor, job_range.done)
+             for job_range in job.ranges],
+            [(ids[1], ids[1], True), (None, ids[4], True)])
+
+    def test_resume(self):
+        """A job abandoned by its runner resumes after the cursors of its
+        last checkpoints.
+        """
+        ids = [contact.id for contact in self.contactmgr.contacts]
+        job = self._run('relocate', state=models.Job.RUNNING,
+                        owner='gone', ranges=[
+                            models.JobRange(0, ids[1]),
+                            models.JobRange(ids[2])])
+
+        self.assertEqual(job.state, models.Job.DONE)
+        self.assertEqual(job.processed, 4)
+        self.assertEqual(job.ranges[1].cursor, ids[4])
+
+    def test_claimed(self):
+        """A job another runner is running isn't run, until that runner
+        stops checkpointing.
+        """
+        job = self._run('relocate', state=models.Job.RUNNING,
+                        owner='other', heartbeat=datetime.utcnow())
+        self.assertEqual((job.owner, job.processed), ('other', 0))
+
+        job.heartbeat -= timedelta(seconds=constants.JOB_STALE_AFTER + 1)
+        self.session.commit()
+        jobs.JobRunner(processes=0).submit(job.id, self.engine)
+
+        self.session.expire_all()
+        self.assertNotEqual(job.owner, 'other')
+        self.assertEqual((job.state, job.processed), (models.Job.DONE, 5))
+
+    def test_lost_claim(self):
+        """A worker whose runner no longer holds the job stops, discarding
+        its chunk.
+        """
+        contact = self.contactmgr.contacts[0]
+        contact.state = 'nc'
+        job = models.Job('normalize', 2)
+        job.state, job.owner = models.Job.RUNNING, 'other'
+        job.ranges = [models.JobRange(0)]
+        self.session.add(job)
+        self.session.commit()
+
+        jobs.run_range(job.ranges[0].id, 'me', self.engine)
+
+        self.session.expire_all()
+        self.assertEqual((job.owner, job.state, job.processed),
+                         ('other', models.Job.RUNNING, 0))
+        self.assertEqual(job.ranges[0].cursor, 0)
+        self.assertEqual(contact.state, 'nc')
+
+    def test_cancelled(self):
+        """A job that was asked to cancel stops before its next chunk."""
+        job = self._run('relocate', cancel_requested=True)
+
+        self.assertEqual(job.state, models.Job.CANCELLED)
+        self.assertEqual(job.processed, 0)
+
+    def test_failed(self):
+        """A failing task marks the job as failed with the traceback."""
+        def explode(session, contacts, params):
+            raise ValueError('boom')
+        jobs.TASKS['explode'] = explode
+        try:
+            job = self._run('explode')
+        finally:
+            del jobs.TASKS['explode']
+
+        self.assertEqual(job.state, models.Job.FAILED)
+        self.assertIn('ValueError: boom', job.error)
+
+    def test_finished(self):
+        """Finished jobs aren't run again."""
+        job = self._run('relocate', state=models.Job.DONE)
+        self.assertEqual(job.processed, 0)
+
+
+class TestTasks(CommonFixture):
+    """Tests for the maintenance tasks."""
+
+    def test_normalize(self):
+        """Stored contacts are normalized."""
+        contact = self.contactmgr.contacts[0]
+        contact.firstname = '  Jane   Ann '
+        contact.state = 'nc'
+        self.session.commit()
+
+        self._run('normalize')
+
+        self.session.refresh(contact)
+        self.assertEqual(contact.firstname, 'Jane Ann')
+        self.assertEqual(contact.state, 'NC')
+
+    def test_dedup(self):
+        """Duplicates of earlier contacts are deleted across chunks and
+        ranges.
+        """
+        self.session.add_all([
+            models.Contact('f0', 'l0', '28409', 'c', 'NC'),
+            models.Contact('f4', 'l4', '28409', 'c', 'NC'),
+            models.Contact('f4', 'l4', '28409', 'c', 'NC'),
+            models.Contact('f4', 'l4', '28401', 'c', 'NC'),
+        ])
+        for contact in self.session.query(models.Contact):
+            contact.contactmgr_id = self.contactmgr.id
+        self.session.commit()
+        kept = [contact.id for contact in self.contactmgr.contacts]
+        kept = kept[:5] + kept[-1:]
+
+        self._run('dedup', concurrency=3)
+
+        self.session.expire_all()
+        self.assertEqual(
+            [contact.id for contact in self.session.query(
+                models.Contact).order_by(models.Contact.id)],
+            kept)
+
+
+class TestJobRunner(unittest.TestCase):
+    """Tests for running jobs in the process pool."""
+
+    def setUp(self):
+        """Initialize a database file that pool processes can open."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_uri = 'sqlite:///%s' % os.path.join(self.tmpdir, 'jobs.db')
+        self.engine = create_engine(self.db_uri)
+        models.init_model(self.engine)
+
+        self.session = sessionmaker(bind=self.engine)()
+        self.session.add(models.ContactManager(contacts=[
+            models.Contact('f1', 'l1', '28409', 'c1', 'nc'),
+            models.Contact('f2', 'l2', '28409', 'c2', 'nc')]))
+        self.job = models.Job('normalize', 1)
+        self.session.add(self.job)
+        self.session.commit()
+
+    def tearDown(self):
+        """Clobber the database file."""
+        self.session.close()
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def _job(self):
+        """The job, reloaded."""
+        self.session.expire_all()
+        return self.session.query(models.Job).get(self.job.id)
+
+    def test_pool(self):
+        """A job's ranges run concurrently in the pool once it is started."""
+        self.job.concurrency = 2
+        self.session.commit()
+
+        runner = jobs.JobRunner(processes=2)
+        runner.start()
+        try:
+            results = runner.submit(self.job.id, self.engine)
+            for result in results:
+                result.get(30)
+        finally:
+            runner.close()
+
+        job = self._job()
+        self.assertEqual(len(results), 2)
+        self.assertEqual((job.state, job.processed), (models.Job.DONE, 2))
+
+    def test_not_started(self):
+        """Submitting to a pool that isn't started is an error and leaves
+        the job pending for `resume`.
+        """
+        runner = jobs.JobRunner(processes=1)
+        self.assertRaises(jobs.NotStarted, runner.submit, self.job.id,
+                          self.engine)
+        self.assertEqual(self._job().state, models.Job.PENDING)
+
+    def test_resume(self):
+        """Resuming claims each job once, however many runners resume it."""
+        runners = [jobs.JobRunner(processes=1) for _ in range(2)]
+        for runner in runners:
+            runner.start()
+        try:
+            for runner in runners:
+                runner.resume(self.engine)
+        finally:
+            for runner in runners:
+                runner.close()
+
+        job = self._job()
+        self.assertEqual(job.owner, runners[0].owner)
+        self.assertEqual((job.state, job.processed), (models.Job.DONE, 2))
+
+    def test_run_in_process__error(self):
+        """Errors run_range doesn't handle mark the job as failed."""
+        runner = jobs.JobRunner(processes=0)
+        jobs.claim(self.session, self.job.id, runner.owner)
+        range_id, = jobs.plan(self.session, self.job.id)
+
+        def explode(range_id, owner, engine):
+            raise RuntimeError('boom')
+        run_range, jobs.run_range = jobs.run_range, explode
+        try:
+            jobs._run_in_process(range_id, runner.owner, self.db_uri)
+        finally:
+            jobs.run_range = run_range
+
+        job = self._job()
+        self.assertEqual(job.state, models.Job.FAILED)
+        self.assertIn('RuntimeError: boom', job.error)
@@ -4,12 +4,14 @@ relationships and attributes vital to functionality.
 
 import unittest
 
+import sqlalchemy
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import ujson
 import webapp2
 
 from src import contact_manager
+from src import geo
 from src import models
 
 
@@ -129,7 +131,7 @@ class TestContactManager(CommonFixture):
         """
         request = webapp2.Request.blank('/')
         request.body = ujson.dumps([
-            ['', '-1', 'f1', 'l1', 'z1', 'c1', 's1'],
+            ['', '-1', 'f1', 'l1', '28401', 'c1', 'NC'],
         ])
 
         contactmgr = models.ContactManager()
@@ -141,9 +143,9 @@ class TestContactManager(CommonFixture):
 
         self.assertEqual(contact.firstname, 'f1')
         self.assertEqual(contact.lastname, 'l1')
-        self.assertEqual(contact.zipcode, 'z1')
+        self.assertEqual(contact.zipcode, '28401')
         self.assertEqual(contact.city, 'c1')
-        self.assertEqual(contact.state, 's1')
+        self.assertEqual(contact.state, 'NC')
 
     def test_update_from_post__N_new_contact(self):
         """Assert that adding a contact in a POSTed form results in the
@@ -151,8 +153,8 @@ class TestContactManager(CommonFixture):
         """
         request = webapp2.Request.blank('/')
         request.body = ujson.dumps([
-            ['', '-1', 'f1', 'l1', 'z1', 'c1', 's1'],
-            ['', '-1', 'f2', 'l2', 'z2', 'c2', 's2'],
+            ['', '-1', 'f1', 'l1', '28401', 'c1', 'NC'],
+            ['', '-1', 'f2', 'l2', '28402', 'c2', 'NC'],
         ])
 
         contactmgr = models.ContactManager()
@@ -163,16 +165,16 @@ class TestContactManager(CommonFixture):
         contact = contactmgr.contacts[0]
         self.assertEqual(contact.firstname, 'f1')
         self.assertEqual(contact.lastname, 'l1')
-        self.assertEqual(contact.zipcode, 'z1')
+        self.assertEqual(contact.zipcode, '28401')
         self.assertEqual(contact.city, 'c1')
-        self.assertEqual(contact.state, 's1')
+        self.assertEqual(contact.state, 'NC')
 
         contact = contactmgr.contacts[1]
         self.assertEqual(contact.firstname, 'f2')
         self.assertEqual(contact.lastname, 'l2')
-        self.assertEqual(contact.zipcode, 'z2')
+        self.assertEqual(contact.zipcode, '28402')
         self.assertEqual(contact.city, 'c2')
-        self.assertEqual(contact.state, 's2')
+        self.assertEqual(contact.state, 'NC')
 
     def test_update_from_post__1_edit_contact(self):
         """Assert that adding a contact in a POSTed form results in the
@@ -180,7 +182,7 @@ class TestContactManager(CommonFixture):
         """
         request = webapp2.Request.blank('/')
         request.body = ujson.dumps([
-            ['', self.contact1.id, 'f1', 'l1', 'z1', 'c1', 's1'],
+            ['', self.contact1.id, 'f1', 'l1', '28401', 'c1', 'NC'],
         ])
 
         contactmgr = models.ContactManager(contacts=[self.contact1])
@@ -192,9 +194,9 @@ class TestContactManager(CommonFixture):
         self.assertEqual(contact.id, self.contact1.id)
         self.assertEqual(contact.firstname, 'f1')
         self.assertEqual(contact.lastname, 'l1')
-        self.assertEqual(contact.zipcode, 'z1')
+        self.assertEqual(contact.zipcode, '28401')
         self.assertEqual(contact.city, 'c1')
-        self.assertEqual(contact.state, 's1')
+        self.assertEqual(contact.state, 'NC')
 
     def test_update_from_post__N_edit_contact(self):
         """Assert that adding a contact in a POSTed form results in the
@@ -202,8 +204,8 @@ class TestContactManager(CommonFixture):
         """
         request = webapp2.Request.blank('/')
         request.body = ujson.dumps([
-            ['', self.contact1.id, 'f1', 'l1', 'z1', 'c1', 's1'],
-            ['', self.contact2.id, 'f2', 'l2', 'z2', 'c2', 's2'],
+            ['', self.contact1.id, 'f1', 'l1', '28401', 'c1', 'NC'],
+            ['', self.contact2.id, 'f2', 'l2', '28402', 'c2', 'NC'],
         ])
 
         contactmgr = models.ContactManager(
@@ -216,17 +218,17 @@ class TestContactManager(CommonFixture):
         self.assertEqual(contact.id, self.contact1.id)
         self.assertEqual(contact.firstname, 'f1')
         self.assertEqual(contact.lastname, 'l1')
-        self.assertEqual(contact.zipcode, 'z1')
+        self.assertEqual(contact.zipcode, '28401')
         self.assertEqual(contact.city, 'c1')
-        self.assertEqual(contact.state, 's1')
+        self.assertEqual(contact.state, 'NC')
 
         contact = contactmgr.contacts[1]
         self.assertEqual(contact.id, self.contact2.id)
         self.assertEqual(contact.firstname, 'f2')
         self.assertEqual(contact.lastname, 'l2')
-        self.assertEqual(contact.zipcode, 'z2')
+        self.assertEqual(contact.zipcode, '28402')
         self.assertEqual(contact.city, 'c2')
-        self.assertEqual(contact.state, 's2')
+        self.assertEqual(contact.state, 'NC')
 
     def test_update_from_post__1_create_1_edit_contact(self):
         """Assert that adding a contact in a POSTed form results in the
@@ -234,8 +236,8 @@ class TestContactManager(CommonFixture):
         """
         request = webapp2.Request.blank('/')
         request.body = ujson.dumps([
-            ['', self.contact1.id, 'f1', 'l1', 'z1', 'c1', 's1'],
-            ['', '-1', 'f2', 'l2', 'z2', 'c2', 's2'],
+            ['', self.contact1.id, 'f1', 'l1', '28401', 'c1', 'NC'],
+            ['', '-1', 'f2', 'l2', '28402', 'c2', 'NC'],
         ])
 
         contactmgr = models.ContactManager(contacts=[self.contact1])
@@ -247,13 +249,206 @@ class TestContactManager(CommonFixture):
         self.assertEqual(contact.id, self.contact1.id)
         self.assertEqual(contact.firstname, 'f1')
         self.assertEqual(contact.lastname, 'l1')
-        self.assertEqual(contact.zipcode, 'z1')
+        self.assertEqual(contact.zipcode, '28401')
         self.assertEqual(contact.city, 'c1')
-        self.assertEqual(contact.state, 's1')
+        self.assertEqual(contact.state, 'NC')
 
         contact = contactmgr.contacts[1]
         self.assertEqual(contact.firstname, 'f2')
         self.assertEqual(contact.lastname, 'l2')
-        self.assertEqual(contact.zipcode, 'z2')
+        self.assertEqual(contact.zipcode, '28402')
         self.assertEqual(contact.city, 'c2')
-        self.assertEqual(contact.state, 's2')
+        self.assertEqual(contact.state, 'NC')
+
+
+class TestQueryContacts(CommonFixture):
+    """Test the server side sorting, filtering and faceting of contacts."""
+
+    def setUp(self):
+        """Initialize test fixture."""
+        super(TestQueryContacts, self).setUp()
+        self.contactmgr = models.ContactManager(contacts=[
+            models.Contact('b', 'y', '28409', 'Wilmington', 'NC'),
+            models.Contact('a', 'z', '28401', 'Wilmington', 'NC'),
+            models.Contact('c', 'x', '27601', 'Raleigh', 'NC'),
+            models.Contact('d', 'w', '29401', 'Charleston', 'SC'),
+        ])
+        self.session.add(self.contactmgr)
+        self.session.commit()
+
+    def _firstnames(self, **kwargs):
+        """The firstnames of the queried contacts, in order."""
+        return [contact.firstname for contact in models.query_contacts(
+            self.session, self.contactmgr.id, **kwargs)]
+
+    def test_default_order(self):
+        """Without a sort, contacts come back in id order."""
+        self.assertEqual(self._firstnames(), ['b', 'a', 'c', 'd'])
+
+    def test_sort(self):
+        """Contacts are sorted by the given field."""
+        self.assertEqual(self._firstnames(sort='firstname'),
+                         ['a', 'b', 'c', 'd'])
+        self.assertEqual(self._firstnames(sort='-zipcode'),
+                         ['d', 'b', 'a', 'c'])
+
+    def test_sort__unknown(self):
+        """Sorting by an unknown field is an error."""
+        self.assertRaises(ValueError, self._firstnames, sort='id; drop')
+
+    def test_filter(self):
+        """Filters narrow down the contacts."""
+        self.assertEqual(self._firstnames(filters={'state': 'SC'}), ['d'])
+        self.assertEqual(
+            self._firstnames(filters={'state': 'NC', 'city': 'Wilmington'}),
+            ['b', 'a'])
+        self.assertEqual(
+            self._firstnames(filters={'zipcode_prefix': '284'}), ['b', 'a'])
+
+    def test_filter__prefix_wildcards(self):
+        """LIKE wildcards in a prefix are matched literally."""
+        self.assertEqual(
+            self._firstnames(filters={'zipcode_prefix': '_'}), [])
+
+    def test_sort__ties(self):
+        """Ties are broken by id, in the direction of the sort."""
+        self.assertEqual(self._firstnames(sort='city'), ['d', 'c', 'b', 'a'])
+        self.assertEqual(self._firstnames(sort='-city'), ['a', 'b', 'c', 'd'])
+
+    def test_page(self):
+        """Queries can be limited to a page."""
+        self.assertEqual(self._firstnames(sort='firstname', limit=2,
+                                          offset=1), ['b', 'c'])
+
+    def test_filter__other_contactmgr(self):
+        """Contacts of other contact managers are never returned."""
+        self.assertEqual(
+            list(models.query_contacts(self.session, self.contactmgr.id + 1)),
+            [])
+
+    def test_facet_counts(self):
+        """Contacts are counted per state and per city within a state."""
+        self.assertEqual(
+            models.facet_counts(self.session, self.contactmgr.id),
+            {'state': {'NC': 3, 'SC': 1},
+             'city': {'NC': {'Wilmington': 2, 'Raleigh': 1},
+                      'SC': {'Charleston': 1}}})
+
+
+class TestNearbyContacts(CommonFixture):
+    """Test the proximity search over contacts."""
+
+    def setUp(self):
+        """Initialize test fixture."""
+        super(TestNearbyContacts, self).setUp()
+        self.contactmgr = models.ContactManager(contacts=[
+            models.Contact('a', 'a', '28409', 'Wilmington', 'NC'),
+            models.Contact('b', 'b', '28401', 'Wilmington', 'NC'),
+            models.Contact('c', 'c', '27601', 'Raleigh', 'NC'),
+            models.Contact('d', 'd', '90210', 'Beverly Hills', 'CA'),
+            models.Contact('e', 'e', 'zip', 'Nowhere', 'NC'),
+        ])
+        self.session.add(self.contactmgr)
+        self.session.commit()
+
+    def test_locate(self):
+        """Contacts are located when their ZIP code is set."""
+        contact = self.contactmgr.contacts[0]
+        self.assertEqual((contact.latitude, contact.longitude),
+                         geo.locate('28409'))
+        self.assertEqual(contact.geocell, geo.cell(*geo.locate('28409')))
+
+        contact.zipcode = 'zip'
+        self.assertEqual(contact.geocell, None)
+
+    def test_locate__cleared(self):
+        """Clearing the ZIP code clears the location."""
+        contact = self.contactmgr.contacts[0]
+        contact.zipcode = ''
+        self.assertEqual(
+            (contact.latitude, contact.longitude, contact.geocell),
+            (None, None, None))
+
+    def test_contacts_order(self):
+        """Contacts load in id order, whatever index the query uses, e.g.
+        contacts with unknown ZIPs don't come first.
+        """
+        self.session.expire_all()
+        contactmgr = self.session.query(models.ContactManager).one()
+        self.assertEqual(
+            [contact.firstname for contact in contactmgr.contacts],
+            ['a', 'b', 'c', 'd', 'e'])
+
+    def test_nearby_contacts(self):
+        """Contacts within the radius come back nearest first."""
+        lat, lon = geo.locate('28403')
+        found = models.nearby_contacts(
+            self.session, self.contactmgr.id, lat, lon, 150)
+        self.assertEqual([contact.firstname for contact, _ in found],
+                         ['a', 'b', 'c'])
+        self.assertTrue(found[0][1] < found[1][1] < found[2][1] <= 150)
+
+        found = models.nearby_contacts(
+            self.session, self.contactmgr.id, lat, lon, 10)
+        self.assertEqual([contact.firstname for contact, _ in found],
+                         ['a', 'b'])
+
+    def test_nearby_contacts__page(self):
+        """A page of the contacts found can be loaded."""
+        lat, lon = geo.locate('28403')
+        found = models.nearby_contacts(
+            self.session, self.contactmgr.id, lat, lon, 150, limit=2,
+            offset=1)
+        self.assertEqual([contact.firstname for contact, _ in found],
+                         ['b', 'c'])
+
+
+class TestUpgradeModel(unittest.TestCase):
+    """Test upgrading tables made by an older init_model."""
+
+    def setUp(self):
+        """Create the contacts table as it was before contacts were
+        located.
+        """
+        self.engine = create_engine('sqlite:///:memory:', echo=True)
+        self.engine.execute(
+            'CREATE TABLE contactmgrs (id INTEGER PRIMARY KEY, '
+            'created DATETIME, modified DATETIME, title VARCHAR(256))')
+        self.engine.execute(
+            'CREATE TABLE contacts (id INTEGER PRIMARY KEY, '
+            'created DATETIME, modified DATETIME, contactmgr_id INTEGER, '
+            'firstname VARCHAR(128), lastname VARCHAR(128), '
+            'zipcode VARCHAR(16), city VARCHAR(256), state VARCHAR(4))')
+        self.engine.execute(
+            "INSERT INTO contacts (firstname, lastname, zipcode, city, state) "
+            "VALUES ('f1', 'l1', '28409', 'Wilmington', 'NC'), "
+            "('f2', 'l2', 'zip', 'Nowhere', 'NC')")
+
+    def test_upgrade_model(self):
+        """Missing columns, indexes and tables are added and the existing
+        contacts are located.
+        """
+        models.upgrade_model(self.engine)
+
+        inspector = sqlalchemy.inspect(self.engine)
+        self.assertTrue(set(['latitude', 'longitude', 'geocell']) <= set(
+            column['name'] for column in inspector.get_columns('contacts')))
+        self.assertEqual(
+            set(index.name for index in models.Contact.__table__.indexes),
+            set(index['name'] for index in inspector.get_indexes('contacts')))
+        self.assertTrue(set(['jobs', 'job_ranges']) <= set(
+            inspector.get_table_names()))
+
+        session = sessionmaker(bind=self.engine)()
+        located, unknown = session.query(models.Contact).order_by(
+            models.Contact.id).all()
+        self.assertEqual((located.latitude, located.longitude),
+                         geo.locate('28409'))
+        self.assertEqual(located.geocell, geo.cell(*geo.locate('28409')))
+        self.assertEqual(unknown.geocell, None)
+        session.close()
+
+    def test_upgrade_model__twice(self):
+        """Upgrading an up to date database changes nothing."""
+        models.upgrade_model(self.engine)
+        models.upgrade_model(self.engine)
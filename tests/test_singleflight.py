@@ -0,0 +1,115 @@
+"""Test suite for singleflight.py's request coalescing."""
+
+import threading
+import time
+import unittest
+
+from src import singleflight
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Tests for sharing one computation between concurrent callers."""
+
+    def setUp(self):
+        """Initialize test fixture."""
+        self.flight = singleflight.SingleFlight()
+        self.release = threading.Event()
+        self.calls = []
+
+    def _slow(self, result=None, error=None):
+        """A computation that runs until released."""
+        def func():
+            self.calls.append(1)
+            self.release.wait(5)
+            if error is not None:
+                raise error
+            return result
+        return func
+
+    def _spawn(self, func, count, key='key', timeout=5):
+        """Call the single flight concurrently, collecting results/errors."""
+        results = []
+
+        def run():
+            try:
+                results.append(self.flight.do(key, func, timeout=timeout))
+            except Exception as err:
+                results.append(err)
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def _wait_until(self, condition, message, timeout=5):
+        """Poll until `condition()` holds, failing after `timeout` seconds."""
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail(message)
+            time.sleep(0.001)
+
+    def _wait_for_followers(self, key, count):
+        """Wait until `count` followers are waiting on `key`."""
+        self._wait_until(lambda: self.flight.followers(key) >= count,
+                         '%d followers never joined %r' % (count, key))
+
+    def test_shared_result(self):
+        """Concurrent callers share a single computation's result."""
+        threads, results = self._spawn(self._slow(result='html'), 10)
+        self._wait_for_followers('key', 9)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, ['html'] * 10)
+        self.assertEqual(self.flight.in_flight(), 0)
+
+    def test_shared_error(self):
+        """The leader's exception is raised in every caller."""
+        error = ValueError('boom')
+        threads, results = self._spawn(self._slow(error=error), 5)
+        self._wait_for_followers('key', 4)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, [error] * 5)
+
+    def test_followers(self):
+        """Followers are counted until the computation finishes."""
+        self.assertEqual(self.flight.followers('key'), 0)
+        threads, _ = self._spawn(self._slow(result='html'), 3)
+        self._wait_for_followers('key', 2)
+        self.assertEqual(self.flight.followers('key'), 2)
+
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.flight.followers('key'), 0)
+
+    def test_distinct_keys(self):
+        """Different keys don't share computations."""
+        self.release.set()
+        self.assertEqual(self.flight.do('a', lambda: 'a'), 'a')
+        self.assertEqual(self.flight.do('b', lambda: 'b'), 'b')
+
+    def test_timeout(self):
+        """Followers stop waiting after the timeout."""
+        leader, _ = self._spawn(self._slow(result='html'), 1)
+        self._wait_until(self.flight.in_flight, 'The leader never started')
+
+        self.assertRaises(singleflight.Timeout, self.flight.do, 'key',
+                          lambda: 'unused', timeout=0.01)
+
+        self.release.set()
+        leader[0].join()
+
+    def test_not_cached(self):
+        """A finished computation isn't reused by later callers."""
+        self.release.set()
+        self.flight.do('key', self._slow(result=1))
+        self.flight.do('key', self._slow(result=2))
+        self.assertEqual(len(self.calls), 2)
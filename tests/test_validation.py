@@ -0,0 +1,76 @@
+"""Test suite for validation.py's contact schema."""
+
+import unittest
+
+from src import models
+from src import validation
+
+
+class TestContactSchema(unittest.TestCase):
+    """Tests for validating and normalizing batches of contacts."""
+
+    def setUp(self):
+        """Initialize test fixture."""
+        self.schema = validation.ContactSchema(models.Contact)
+
+    def _record(self, **kwargs):
+        """A valid record, overridden by kwargs."""
+        record = {'id': '-1', 'firstname': 'f', 'lastname': 'l',
+                  'zipcode': '28409', 'city': 'Wilmington', 'state': 'NC'}
+        record.update(kwargs)
+        return record
+
+    def test_max_lengths(self):
+        """Length limits come from the model's column definitions."""
+        self.assertEqual(self.schema.max_lengths['firstname'], 128)
+        self.assertEqual(self.schema.max_lengths['zipcode'], 16)
+        self.assertEqual(self.schema.max_lengths['state'], 4)
+
+    def test_normalize(self):
+        """Whitespace is collapsed and states are upper cased."""
+        cleaned = self.schema.validate([self._record(
+            id=' 7 ', firstname='  Jane \t Ann ', zipcode=' 28409-1234',
+            state='nc')])
+        self.assertEqual(cleaned, [{
+            'id': 7, 'firstname': 'Jane Ann', 'lastname': 'l',
+            'zipcode': '28409-1234', 'city': 'Wilmington', 'state': 'NC'}])
+
+    def test_optional(self):
+        """City and state may be blank when the ZIP lookup failed."""
+        cleaned = self.schema.validate([self._record(city='', state=None)])
+        self.assertEqual(cleaned[0]['city'], '')
+        self.assertEqual(cleaned[0]['state'], '')
+
+    def test_errors_per_row(self):
+        """Every bad row of the batch is reported by index."""
+        try:
+            self.schema.validate([
+                self._record(),
+                self._record(lastname='x' * 129, state='North Carolina'),
+                self._record(id='abc', zipcode='2840'),
+            ])
+        except validation.ValidationError as err:
+            self.assertEqual(err.errors, {
+                1: {'lastname': 'must be at most 128 characters',
+                    'state': 'must be at most 4 characters'},
+                2: {'id': 'must be an integer',
+                    'zipcode': 'must be a ZIP or ZIP+4 code'},
+            })
+        else:
+            self.fail('ValidationError not raised')
+
+    def test_validate_table_rows(self):
+        """Rows of table cells are mapped onto the contact fields."""
+        cleaned = self.schema.validate_table_rows(
+            [['', '-1', 'f', 'l', '28409', 'Wilmington', 'nc']])
+        self.assertEqual(cleaned[0]['id'], validation.NEW_ID)
+        self.assertEqual(cleaned[0]['state'], 'NC')
+
+    def test_validate_table_rows__bad_shape(self):
+        """Rows with the wrong number of cells are reported as such."""
+        try:
+            self.schema.validate_table_rows([['', '-1', 'f']])
+        except validation.ValidationError as err:
+            self.assertEqual(err.errors, {0: {'row': 'must have 7 cells'}})
+        else:
+            self.fail('ValidationError not raised')